@@ -0,0 +1,220 @@
+"""
+This script benchmarks every get_* method of Order, Product, Seller and Review for my
+Olist project, on synthetic datasets of increasing size (see olist_scripts.synth), and
+writes the timings and peak memory to a json report. It also times the typical joins
+on string ids against the same joins on their integer codes (see olist_scripts.keys).
+Two reports can be compared to catch regressions, e.g.
+    python -m olist_scripts.bench --scales 0.1 1 --output new.json --baseline old.json
+"""
+
+import argparse
+import json
+import platform
+import tempfile
+import time
+import tracemalloc
+import os
+import numpy as np
+import pandas as pd
+from olist_scripts.data import Olist
+from olist_scripts.keys import get_encoded
+from olist_scripts.order import Order
+from olist_scripts.product import Product
+from olist_scripts.seller import Seller
+from olist_scripts.review import Review
+from olist_scripts.synth import write_dataset
+
+CLASSES = [Order, Product, Seller, Review]
+
+# calls with non default arguments that are benchmarked too, as (class, method, kwargs)
+EXTRA_CASES = [(Order, "get_training_data", {"with_distance_seller_customer": True}),
+               (Order, "get_timedeltas", {"is_delivered": False})]
+
+
+# joins benchmarked on string ids and on their codes, as name -> (function of a function
+# returning the tables, the key, column and aggregation of the groupby that follows the join)
+KEY_JOINS = {
+    "orders-items-sellers": (lambda table: table("orders_df").merge(table("order_items_df"), on = "order_id",
+                                                                    how = "left")
+                             .merge(table("sellers_df"), on = "seller_id", how = "left"),
+                             "seller_id", "order_id", "nunique"),
+    "orders-reviews-items": (lambda table: table("orders_df").merge(table("order_reviews_df"), on = "order_id",
+                                                                    how = "left")
+                             .merge(table("order_items_df"), on = "order_id", how = "left"),
+                             "seller_id", "review_score", "mean"),
+    "products-items": (lambda table: table("products_df").merge(table("order_items_df"), on = "product_id",
+                                                                how = "left"),
+                       "product_id", "order_id", "nunique")}
+
+
+def get_cases() -> list:
+    """
+    Returns every (class, method name, kwargs) to benchmark: each get_* method with its
+    default arguments, plus EXTRA_CASES
+    """
+    cases = [(cls, name, {}) for cls in CLASSES for name in sorted(vars(cls)) if name.startswith("get_")]
+
+    return cases + EXTRA_CASES
+
+
+def get_case_name(cls, method, kwargs) -> str:
+    arguments = ", ".join(f"{key}={value}" for (key, value) in kwargs.items())
+
+    return f"{cls.__name__}.{method}({arguments})"
+
+
+def fresh_data(olist):
+    """
+    Returns the data of olist with every table loaded but nothing derived from them yet,
+    so that each case pays for the derived tables it needs
+    """
+    Olist.clear_cache()
+    data = olist.retrieve_data()
+
+    for key_name in data:
+        data[key_name]
+
+    return data
+
+
+def run_case(olist, cls, method, kwargs, repeat = 3) -> dict:
+    """
+    Returns the best wall time (in seconds) out of repeat runs of the case, the peak
+    memory allocated during one more (traced) run, and the size of the output
+    """
+    times = []
+    for _ in range(repeat):
+        instance = cls(fresh_data(olist))
+
+        start = time.perf_counter()
+        result = getattr(instance, method)(**kwargs)
+        times.append(time.perf_counter() - start)
+
+    # tracing memory slows things down, so it gets a run of its own
+    instance = cls(fresh_data(olist))
+    tracemalloc.start()
+    getattr(instance, method)(**kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # methods returning a matrix and its column names are measured by the matrix
+    output = result[0] if isinstance(result, tuple) else result
+
+    return {"case": get_case_name(cls, method, kwargs), "seconds": min(times), "peak_mb": peak/1e6,
+            "rows_out": int(output.shape[0]), "columns_out": int(output.shape[1])}
+
+
+def run_key_benchmark(data, repeat = 3) -> list:
+    """
+    Returns the best wall time of every join of KEY_JOINS (and its groupby) and the
+    memory of the joined df, on the string ids of data and on their int32 codes. The
+    codes are encoded beforehand, like they are once per dataset. The memory is measured
+    on the df, since tracemalloc does not see the buffers of the Arrow backed strings.
+    """
+    tables = {"string": lambda key_name: data[key_name],
+              "int32": lambda key_name: get_encoded(data, key_name)}
+
+    for key_name in ["orders_df", "order_items_df", "order_reviews_df", "products_df", "sellers_df"]:
+        get_encoded(data, key_name)
+
+    results = []
+    for (name, (join, key, column, aggregation)) in KEY_JOINS.items():
+        for (keys, table) in tables.items():
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                joined = join(table)
+                joined.groupby(key)[column].agg(aggregation)
+                times.append(time.perf_counter() - start)
+
+            results.append({"case": f"join {name} ({keys} keys)", "seconds": min(times),
+                            "joined_mb": float(joined.memory_usage(deep = True).sum())/1e6})
+
+    return results
+
+
+def run_benchmark(scales, seed = 42, repeat = 3, data_dir = None) -> dict:
+    """
+    Generates a synthetic dataset for every scale, times the csv load and every case on
+    it, and returns the report as a dictionary
+    """
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "seed": seed, "repeat": repeat,
+              "python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+              "results": []}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for scale in scales:
+            csv_path = os.path.join(data_dir or temp_dir, f"scale_{scale}")
+            write_dataset(csv_path, scale, seed, overwrite = True)
+            olist = Olist(csv_path, feature_cache = False)
+
+            # the first load parses the csv files and writes the snapshots, the second reads them
+            for case in ["Olist.retrieve_data(cold)", "Olist.retrieve_data(snapshot)"]:
+                start = time.perf_counter()
+                data = fresh_data(olist)
+                report["results"].append({"scale": scale, "case": case, "seconds": time.perf_counter() - start,
+                                          "rows": {key_name: len(data[key_name]) for key_name in data}})
+
+            for (cls, method, kwargs) in get_cases():
+                result = run_case(olist, cls, method, kwargs, repeat)
+                result["scale"] = scale
+                report["results"].append(result)
+                print(f"scale {scale}: {result['case']} {result['seconds']:.3f}s {result['peak_mb']:.1f}MB")
+
+            for result in run_key_benchmark(fresh_data(olist), repeat):
+                result["scale"] = scale
+                report["results"].append(result)
+                print(f"scale {scale}: {result['case']} {result['seconds']:.3f}s {result['joined_mb']:.1f}MB joined")
+
+    return report
+
+
+def compare_reports(baseline, current, tolerance = 0.2, min_seconds = 0.01) -> pd.DataFrame:
+    """
+    Returns a df with the seconds and peak memory of every case and scale of both reports,
+    and whether the current one regressed by more than tolerance (a fraction) in either.
+    Slowdowns of less than min_seconds are ignored, since they are mostly noise.
+    """
+    columns = ["scale", "case", "seconds", "peak_mb"]
+    old = pd.DataFrame(baseline["results"]).reindex(columns = columns)
+    new = pd.DataFrame(current["results"]).reindex(columns = columns)
+
+    df = old.merge(new, on = ["scale", "case"], suffixes = ("_baseline", "_current"))
+
+    df["time_ratio"] = df["seconds_current"]/df["seconds_baseline"]
+    df["memory_ratio"] = df["peak_mb_current"]/df["peak_mb_baseline"]
+    slower = (df["time_ratio"] > 1 + tolerance) & (df["seconds_current"] - df["seconds_baseline"] > min_seconds)
+    df["regressed"] = slower | (df["memory_ratio"] > 1 + tolerance)
+
+    return df
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmarks the olist_scripts feature methods")
+    parser.add_argument("--scales", type = float, nargs = "+", default = [0.01, 0.1],
+                        help = "dataset sizes relative to the Kaggle dataset")
+    parser.add_argument("--seed", type = int, default = 42)
+    parser.add_argument("--repeat", type = int, default = 3, help = "timed runs per case, the best one is kept")
+    parser.add_argument("--data-dir", default = None, help = "keep the generated datasets here")
+    parser.add_argument("--output", default = "bench_report.json", help = "where to write the json report")
+    parser.add_argument("--baseline", default = None, help = "a previous report to compare against")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "allowed slowdown, as a fraction")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.scales, args.seed, args.repeat, args.data_dir)
+
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent = 2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            comparison = compare_reports(json.load(file), report, args.tolerance)
+
+        print(comparison.to_string(index = False))
+
+        if comparison["regressed"].any():
+            raise SystemExit(f"{comparison['regressed'].sum()} case(s) regressed")
+
+
+if __name__ == "__main__":
+    main()
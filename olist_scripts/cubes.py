@@ -0,0 +1,378 @@
+"""
+This script materializes aggregate cubes for the dashboard of my Olist project, and
+serves them. The revenue, orders, items, mean review score, mean wait time and mean
+delay are precomputed for every combination of category x seller_state x
+customer_state x purchase_month, grouped by every subset of those dimensions (like
+SQL's GROUP BY CUBE), so that a query only has to slice one of them.
+
+The cubes are built offline and written atomically to a single Arrow file, e.g.
+    python -m olist_scripts.cubes build
+    python -m olist_scripts.cubes serve --port 8050
+Readers keep answering from the previous cubes while new ones are built, and switch
+to them once the file is replaced.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from olist_scripts.data import Olist
+from olist_scripts.keys import get_encoded
+from olist_scripts.snapshot import STRING_TYPES
+from olist_scripts.timeline import get_order_timeline
+
+DIMENSIONS = ["category", "seller_state", "customer_state", "purchase_month"]
+
+# measures that add up when cells are rolled up, and the means computed out of them
+SUMS = ["revenue", "orders", "items", "review_score_sum", "review_score_count", "wait_time_sum",
+        "wait_time_count", "delay_sum", "delay_count"]
+MEANS = {"mean_review_score": ("review_score_sum", "review_score_count"),
+         "mean_wait_time": ("wait_time_sum", "wait_time_count"),
+         "mean_delay": ("delay_sum", "delay_count")}
+MEASURES = ["revenue", "orders", "items", *MEANS]
+
+CUBES_FILE_NAME = "cubes.arrow"
+
+# the column telling which dimensions a row is grouped by, e.g. "category,purchase_month"
+GROUPING = "grouping"
+
+
+def get_grouping(dimensions) -> str:
+    return ",".join(dimension for dimension in DIMENSIONS if dimension in dimensions)
+
+
+def build_facts(data) -> pd.DataFrame:
+    """
+    Returns a df with a row per order and combination of dimensions its items fall in,
+    with the number of items and revenue of those items, and the order's review score,
+    wait time and delay (0 if it arrived early, like in Order.get_timedeltas)
+    """
+    items = get_encoded(data, "order_items_df", columns = ["order_id", "product_id", "seller_id", "price"])
+    orders = get_encoded(data, "orders_df", columns = ["order_id", "customer_id", "order_purchase_timestamp"])
+    products = get_encoded(data, "products_df", columns = ["product_id", "product_category_name"])
+    sellers = get_encoded(data, "sellers_df", columns = ["seller_id", "seller_state"])
+    customers = get_encoded(data, "customers_df", columns = ["customer_id", "customer_state"])
+    translation = data["product_category_name_translation_df"]
+
+    products = products.merge(translation, on = "product_category_name", how = "left")
+    df = items.merge(orders, on = "order_id").merge(products, on = "product_id", how = "left") \
+        .merge(sellers, on = "seller_id", how = "left").merge(customers, on = "customer_id", how = "left")
+
+    df = pd.DataFrame({"order_id": df["order_id"],
+                       "category": df["product_category_name_english"],
+                       "seller_state": df["seller_state"],
+                       "customer_state": df["customer_state"],
+                       "purchase_month": df["order_purchase_timestamp"].dt.strftime("%Y-%m"),
+                       "price": df["price"]})
+    df[DIMENSIONS] = df[DIMENSIONS].astype("string[pyarrow]")
+
+    facts = df.groupby(["order_id", *DIMENSIONS], dropna = False) \
+        .agg(items = ("price", "size"), revenue = ("price", "sum")).reset_index()
+
+    # the order level measures, the same for every cell of an order
+    reviews = get_encoded(data, "order_reviews_df", columns = ["order_id", "review_score"])
+    reviews = reviews.groupby("order_id")["review_score"].mean()
+    timeline = get_encoded(data, "order_timeline", get_order_timeline,
+                           columns = ["order_id", "wait_time", "delay_vs_expected"]).set_index("order_id")
+
+    facts["review_score"] = reviews.reindex(facts["order_id"]).to_numpy()
+    facts["wait_time"] = timeline["wait_time"].reindex(facts["order_id"]).to_numpy()
+    facts["delay"] = timeline["delay_vs_expected"].clip(lower = 0).reindex(facts["order_id"]).to_numpy()
+
+    return facts
+
+
+def build_cubes(data) -> pd.DataFrame:
+    """
+    Returns the cubes as a single df, with a row per cell of every grouping of the
+    dimensions (see GROUPING), the dimensions it is not grouped by being null
+    """
+    facts = build_facts(data)
+
+    cubes = []
+    for n in range(len(DIMENSIONS) + 1):
+        for dimensions in itertools.combinations(DIMENSIONS, n):
+            dimensions = list(dimensions)
+
+            # an order is counted once per cell, even if several of its finer cells fall in it
+            per_order = facts.groupby(["order_id", *dimensions], dropna = False) \
+                .agg(items = ("items", "sum"), revenue = ("revenue", "sum"), review_score = ("review_score", "first"),
+                     wait_time = ("wait_time", "first"), delay = ("delay", "first"))
+
+            grouped = per_order.groupby(dimensions, dropna = False) if dimensions \
+                else per_order.groupby(np.zeros(len(per_order)))
+            cube = grouped.agg(revenue = ("revenue", "sum"), orders = ("items", "size"), items = ("items", "sum"),
+                               review_score_sum = ("review_score", "sum"),
+                               review_score_count = ("review_score", "count"),
+                               wait_time_sum = ("wait_time", "sum"), wait_time_count = ("wait_time", "count"),
+                               delay_sum = ("delay", "sum"), delay_count = ("delay", "count"))
+
+            cube = cube.reset_index(drop = not dimensions).reindex(columns = [*DIMENSIONS, *SUMS])
+            cube = cube.astype({**{dimension: "string[pyarrow]" for dimension in DIMENSIONS},
+                                **{column: np.float64 for column in SUMS}})
+            cube[GROUPING] = get_grouping(dimensions)
+            cubes.append(cube)
+
+    return pd.concat(cubes, ignore_index = True)
+
+
+def add_means(df) -> pd.DataFrame:
+    """
+    Returns df with the means of MEANS computed out of their sums, and without those sums
+    """
+    for (mean, (total, count)) in MEANS.items():
+        df[mean] = df[total]/df[count].where(df[count] > 0)
+
+    return df.drop(columns = [column for (total, count) in MEANS.values() for column in (total, count)])
+
+
+def write_cubes(cubes, path):
+    """
+    Writes the cubes as an Arrow IPC file, under a temporary name first and then
+    replacing the old file at once, so that readers never see half of them
+    """
+    table = pa.Table.from_pandas(cubes, preserve_index = False)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+
+    with pa.OSFile(temp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    os.replace(temp_path, path)
+
+
+def get_cubes_path(olist = None) -> str:
+    """
+    Returns where the cubes of olist (by default the data in data/) are kept, next to its snapshots
+    """
+    olist = olist or Olist()
+
+    return os.path.join(olist.snapshot_dir, CUBES_FILE_NAME)
+
+
+def refresh_cubes(olist = None) -> str:
+    """
+    Builds the cubes of olist (by default the data in data/) and writes them, returning the path
+    """
+    olist = olist or Olist()
+    path = get_cubes_path(olist)
+
+    cubes = build_cubes(olist.retrieve_data())
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    write_cubes(cubes, path)
+
+    return path
+
+
+class Cubes:
+    """
+    Materialized cubes (see build_cubes), split by grouping, with a query API to slice
+    and roll them up
+    """
+
+    def __init__(self, cubes):
+        self.groupings = {grouping: df.drop(columns = GROUPING).reset_index(drop = True)
+                          for (grouping, df) in cubes.groupby(GROUPING, sort = False)}
+
+    @classmethod
+    def read(cls, path):
+        with pa.memory_map(path) as source:
+            cubes = pa.ipc.open_file(source).read_all().to_pandas(types_mapper = STRING_TYPES.get)
+
+        return cls(cubes)
+
+    def get_values(self) -> dict:
+        """
+        Returns the sorted values of every dimension
+        """
+        return {dimension: sorted(self.groupings[dimension][dimension].dropna().unique())
+                for dimension in DIMENSIONS}
+
+    def query(self, group_by = (), filters = None, measures = None) -> pd.DataFrame:
+        """
+        Returns the measures (by default all of MEASURES) per combination of the group_by
+        dimensions, only for the cells whose dimensions take the values in filters, e.g.
+            query(["purchase_month"], {"category": ["health_beauty"], "seller_state": "SP"})
+
+        A filter with several values rolls their cells up, in which case an order that
+        falls in several of them is counted once in each.
+        """
+        filters = {dimension: [values] if isinstance(values, str) else list(values)
+                   for (dimension, values) in (filters or {}).items()}
+        measures = list(measures or MEASURES)
+
+        unknown = [dimension for dimension in [*group_by, *filters] if dimension not in DIMENSIONS]
+        if unknown:
+            raise ValueError(f"unknown dimensions {unknown}, the dimensions are {DIMENSIONS}")
+
+        unknown = [measure for measure in measures if measure not in MEASURES]
+        if unknown:
+            raise ValueError(f"unknown measures {unknown}, the measures are {MEASURES}")
+
+        # the grouping with every dimension that is grouped by or filtered on
+        dimensions = [dimension for dimension in DIMENSIONS if dimension in group_by or dimension in filters]
+        df = self.groupings[get_grouping(dimensions)]
+
+        mask = np.ones(len(df), dtype = bool)
+        for (dimension, values) in filters.items():
+            mask &= df[dimension].isin(values).to_numpy()
+        df = df[mask]
+
+        group_by = [dimension for dimension in DIMENSIONS if dimension in group_by]
+        if len(group_by) < len(dimensions):
+            # rolling the filtered dimensions up
+            df = df.groupby(group_by, dropna = False)[SUMS].sum().reset_index() if group_by \
+                else df[SUMS].sum().to_frame().T
+
+        df = add_means(df[[*group_by, *SUMS]].copy()).astype({"orders": np.int64, "items": np.int64})
+
+        return df[[*group_by, *measures]].reset_index(drop = True)
+
+
+class CubeStore:
+    """
+    The cubes kept at path, read again whenever the file is replaced. Reads keep using
+    the previous cubes while the new ones are loaded, so a refresh never blocks them, and
+    while the file is missing (e.g. while it is being replaced by hand).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.cubes = None
+        self.version = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Cubes:
+        """
+        Returns the current cubes. If the file was replaced, the new cubes are loaded in
+        the background and returned once they are ready, only the very first read waits.
+        """
+        if self.cubes is None:
+            self.load()
+        elif self.get_version() not in (None, self.version) and self._lock.acquire(blocking = False):
+            threading.Thread(target = self.load, kwargs = {"locked": True}, daemon = True).start()
+
+        return self.cubes
+
+    def get_version(self) -> tuple:
+        """
+        Returns the modification time, size and inode of the file, or None while it is missing
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def load(self, locked = False):
+        if not locked:
+            self._lock.acquire()
+
+        try:
+            version = self.get_version()
+            if self.cubes is None or version not in (None, self.version):
+                try:
+                    self.cubes, self.version = Cubes.read(self.path), version
+                except FileNotFoundError:
+                    # removed since its version was read, only the very first read has nothing to fall back on
+                    if self.cubes is None:
+                        raise
+        finally:
+            self._lock.release()
+
+
+def make_handler(store):
+    """
+    Returns a request handler class answering with the cubes of store, as json
+    """
+
+    class CubeHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+
+            try:
+                if url.path == "/dimensions":
+                    return self.send_json(200, store.get().get_values())
+
+                if url.path == "/query":
+                    group_by = [dimension for value in params.pop("group_by", []) for dimension in value.split(",")
+                                if dimension]
+                    measures = [measure for value in params.pop("measures", []) for measure in value.split(",")
+                                if measure] or None
+                    filters = {dimension: [value for item in values for value in item.split(",")]
+                               for (dimension, values) in params.items()}
+
+                    start = time.perf_counter()
+                    df = store.get().query(group_by, filters, measures)
+                    df = df.astype(object).where(df.notna(), None)
+
+                    return self.send_json(200, {"rows": df.to_dict(orient = "records"),
+                                                "milliseconds": (time.perf_counter() - start)*1e3})
+            except ValueError as error:
+                return self.send_json(400, {"error": str(error)})
+
+            self.send_json(404, {"error": f"unknown path {url.path}, try /query or /dimensions"})
+
+        def log_message(self, format, *args):
+            # keeping the console quiet, the dashboard polls a lot
+            pass
+
+    return CubeHandler
+
+
+def serve(path, host = "127.0.0.1", port = 8050):
+    """
+    Serves the cubes at path over http, e.g.
+        /dimensions
+        /query?group_by=purchase_month&category=health_beauty&measures=revenue,orders
+    """
+    store = CubeStore(path)
+    store.get()
+
+    server = ThreadingHTTPServer((host, port), make_handler(store))
+    print(f"serving {path} on http://{host}:{server.server_port}")
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Builds and serves the Olist dashboard cubes")
+    parser.add_argument("command", choices = ["build", "serve"])
+    parser.add_argument("--data-dir", default = None, help = "directory with the csv files (default: data/)")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8050)
+    args = parser.parse_args(argv)
+
+    olist = Olist(args.data_dir)
+
+    if args.command == "build":
+        start = time.perf_counter()
+        path = refresh_cubes(olist)
+        print(f"wrote {path} in {time.perf_counter() - start:.2f}s")
+    else:
+        serve(get_cubes_path(olist), args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,28 +4,283 @@ It should be working independently of type of machine and location
 """
 
 import os
+import time
+import threading
+from collections.abc import Mapping
 import pandas as pd
+from olist_scripts.profiling import span, count_rows
+from olist_scripts.schema import INDEX_COLUMN, get_read_options
+from olist_scripts.snapshot import SNAPSHOT_DIR_NAME, get_csv_fingerprint, get_snapshot_path, \
+    read_snapshot, write_snapshot
+from olist_scripts.sql import SQLITE_FILE_NAME, OlistSQLite
+
+BACKENDS = ["csv", "sqlite"]
+
+class OlistData(Mapping):
+    """
+    Read-only, dict-like collection of the olist dataframes, whose keys are the
+    table names (e.g. "orders_df"). Each table is only loaded the first time it is
+    accessed, so a job only pays for the tables it actually uses.
+    """
+
+    def __init__(self, olist, fingerprint, columns = None):
+        self.olist = olist
+        self.fingerprint = fingerprint
+        self.columns = columns or {}
+        self.key_names = [os.path.splitext(file)[0] + "_df" for (file, _, _) in fingerprint]
+
+        self._tables = {}
+        self._derived = {}
+
+        # a lock per table and derived table, so that threads only wait for the ones they both need
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get_lock(self, name) -> threading.Lock:
+        """
+        Returns the lock that guards loading or building name
+        """
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def __getitem__(self, key_name):
+        if key_name not in self.key_names:
+            raise KeyError(key_name)
+
+        if key_name not in self._tables:
+            with self.get_lock(("table", key_name)):
+                if key_name not in self._tables:
+                    with span(f"load {key_name}") as result:
+                        self._tables[key_name] = self.olist.read_table(key_name, self.columns.get(key_name))
+                        result["rows_out"] = len(self._tables[key_name])
+
+        return self._tables[key_name]
+
+    def __iter__(self):
+        return iter(self.key_names)
+
+    def __len__(self):
+        return len(self.key_names)
+
+    def __repr__(self):
+        return f"OlistData({self.olist.csv_path!r}, loaded={list(self._tables)})"
+
+    def is_loaded(self, key_name) -> bool:
+        """
+        Returns whether the table key_name has already been loaded
+        """
+        return key_name in self._tables
+
+    def derived(self, name, builder):
+        """
+        Returns the derived table called name, built by builder(self) the first time it
+        is requested and shared afterwards, just like the loaded tables. It is rebuilt
+        together with the rest of the data when a csv file changes. Different tables are
+        built concurrently, but each of them only once.
+        """
+        if name not in self._derived:
+            with self.get_lock(("derived", name)):
+                if name not in self._derived:
+                    with span(f"derive {name}") as result:
+                        self._derived[name] = builder(self)
+                        result["rows_out"] = count_rows(self._derived[name])
+
+        return self._derived[name]
+
+
+def get_derived(data, name, builder):
+    """
+    Returns the derived table name of data, cached on it if data is an OlistData.
+    Plain dictionaries of dataframes get the table built every time.
+    """
+    if isinstance(data, OlistData):
+        return data.derived(name, builder)
+
+    return builder(data)
+
 
 class Olist:
-    def retrieve_data(self) -> dict:
+    """
+    Loads the olist csv files. The loaded data is kept once per process and per data
+    directory, so that every Order, Product, Seller and Review shares the same copy
+    instead of parsing the csv files again.
+
+    Across processes, every table is also kept as a binary snapshot next to the csv
+    files (see olist_scripts.snapshot), unless use_snapshots is False.
+
+    With backend = "sqlite", the tables are read from the sqlite file instead (by
+    default olist.sqlite in the data directory, see olist_scripts.sql).
+
+    The outputs of the get_* methods computed out of the data are kept on disk too (see
+    olist_scripts.feature_cache), unless feature_cache or use_snapshots is False.
+    """
+
+    # process-wide cache, (data directory, requested columns, options) -> OlistData
+    _cache = {}
+    _lock = threading.Lock()
+
+    def __init__(self, csv_path = None, use_snapshots = True, snapshot_dir = None, backend = "csv",
+                 sqlite_file = None, feature_cache = True):
+        if backend not in BACKENDS:
+            raise ValueError(f"backend should be one of {BACKENDS}, not {backend!r}")
+
+        if csv_path is None:
+            # finding root directory wherein the data dir should be
+            rootdir = os.path.dirname(os.path.dirname(__file__))
+
+            # defining absolute path to the dir where the data is
+            csv_path = os.path.join(rootdir, "data")
+
+        self.csv_path = os.path.abspath(csv_path)
+        self.use_snapshots = use_snapshots
+        self.snapshot_dir = snapshot_dir or os.path.join(self.csv_path, SNAPSHOT_DIR_NAME)
+        self.backend = backend
+        self.sqlite_file = os.path.abspath(sqlite_file or os.path.join(self.csv_path, SQLITE_FILE_NAME))
+        self.feature_cache = feature_cache
+
+    def get_file_names(self) -> list:
+        """
+        Returns the sorted names of the csv files in the data folder
+        """
+        return sorted(name for name in os.listdir(self.csv_path) if name[-4:] == ".csv")
+
+    def get_fingerprint(self) -> tuple:
         """
-        Returns a dictionary, whose keys are the names of
+        Returns a tuple with the name, modification time and size of every csv file.
+        Whenever one of those changes, the cached data is loaded again. With the sqlite
+        backend, every table of the sqlite file gets the time and size of the file.
+        """
+        if self.backend == "sqlite":
+            # opening the file first, since creating its indexes modifies it
+            tables = OlistSQLite(self.sqlite_file).get_table_names()
+            stat = os.stat(self.sqlite_file)
+
+            return tuple((table, stat.st_mtime_ns, stat.st_size) for table in tables)
+
+        fingerprint = []
+        for file in self.get_file_names():
+            stat = os.stat(os.path.join(self.csv_path, file))
+            fingerprint.append((file, stat.st_mtime_ns, stat.st_size))
+
+        return tuple(fingerprint)
+
+    def parse_csv(self, key_name, columns = None) -> pd.DataFrame:
+        """
+        Parses a single table (e.g. "orders_df") from its csv file, with the dtypes and
+        dates declared in olist_scripts.schema. If columns is given, only those are read.
+        """
+        file = key_name.replace("_df", ".csv")
+
+        df = pd.read_csv(os.path.join(self.csv_path, file), **get_read_options(key_name, columns))
+        df = df.rename(columns = {"": INDEX_COLUMN})
+
+        # the pyarrow engine parses dates with a precision of seconds, keeping the usual one instead
+        for column in df.select_dtypes(include = "datetime").columns:
+            df[column] = df[column].astype("datetime64[ns]")
+
+        return df
+
+    def read_table(self, key_name, columns = None) -> pd.DataFrame:
+        """
+        Reads a single table (e.g. "orders_df"), only with the given columns if any.
+        The table is memory-mapped from its snapshot if one matches the current csv
+        file, otherwise the csv file is parsed and a new snapshot is written.
+        With the sqlite backend, the table is read from the sqlite file.
+        """
+        if self.backend == "sqlite":
+            return OlistSQLite(self.sqlite_file).read_table(key_name, columns)
+
+        if not self.use_snapshots:
+            return self.parse_csv(key_name, columns)
+
+        csv_file = os.path.join(self.csv_path, key_name.replace("_df", ".csv"))
+        path = get_snapshot_path(self.snapshot_dir, key_name, get_csv_fingerprint(csv_file, key_name))
+
+        if os.path.exists(path):
+            return read_snapshot(path, columns)
+
+        df = self.parse_csv(key_name)
+
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok = True)
+            write_snapshot(df, path)
+        except OSError:
+            # a read-only data dir only means that there will be no snapshots
+            pass
+
+        return df if columns is None else df[list(columns)]
+
+    def retrieve_data(self, columns = None) -> OlistData:
+        """
+        Returns a dictionary-like object, whose keys are the names of
         dataframes containing the olist data, and its values are
         the actual dataframes, loaded from the csv files saved in the
-        data folder
-        """
+        data folder. Each dataframe is only loaded when first accessed.
 
-        # finding root directory wherein the data dir should be
-        rootdir = os.path.dirname(os.path.dirname(__file__))
+        columns can be a dictionary like {"orders_df": ["order_id", "order_status"]},
+        to only read the needed columns of some tables. The rest are read whole.
 
-        # defining absolute path to the dir where the data is
-        csv_path = os.path.join(rootdir, "data")
+        The object is shared by the whole process and is read-only. The dataframes
+        in it are shared too, so they should be copied before being modified.
+        """
+        fingerprint = self.get_fingerprint()
+        columns = columns or {}
+        source = self.sqlite_file if self.backend == "sqlite" else self.csv_path
+        # the options are part of the key, since the shared OlistData keeps the Olist that loaded it
+        cache_key = (source, tuple(sorted((key, tuple(cols)) for (key, cols) in columns.items())),
+                     self.use_snapshots, self.snapshot_dir, self.feature_cache)
 
-        # creating aforementioned dictionary
-        file_names = [name for name in os.listdir(csv_path) if name[-4:] == ".csv"]
-        key_names = [name.replace(".csv", "_df") for name in file_names]
+        with Olist._lock:
+            data = Olist._cache.get(cache_key)
 
-        data = {key_name: pd.read_csv(os.path.join(csv_path, file)) \
-                for (key_name, file) in zip (key_names, file_names)}
+            if data is None or data.fingerprint != fingerprint:
+                data = OlistData(self, fingerprint, columns)
+                Olist._cache[cache_key] = data
 
         return data
+
+    def get_load_report(self) -> pd.DataFrame:
+        """
+        Returns a df with the load time (in seconds) and memory footprint (in MB) of every
+        table, read both as plain csv and with the declared schema, to measure what the
+        schema saves. Also includes the time to read the table's snapshot, if there is one.
+        """
+        report = []
+
+        for file in self.get_file_names():
+            key_name = file.replace(".csv", "_df")
+
+            start = time.perf_counter()
+            plain = pd.read_csv(os.path.join(self.csv_path, file))
+            plain_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            typed = self.parse_csv(key_name)
+            typed_time = time.perf_counter() - start
+
+            snapshot_time = float("nan")
+            if self.use_snapshots:
+                # the first read writes the snapshot, the second one reads it
+                self.read_table(key_name)
+                start = time.perf_counter()
+                self.read_table(key_name)
+                snapshot_time = time.perf_counter() - start
+
+            report.append({"table": key_name, "rows": len(typed),
+                           "plain_seconds": plain_time, "typed_seconds": typed_time,
+                           "snapshot_seconds": snapshot_time,
+                           "plain_mb": plain.memory_usage(deep = True).sum()/1e6,
+                           "typed_mb": typed.memory_usage(deep = True).sum()/1e6})
+
+        report = pd.DataFrame(report)
+        report.loc[len(report)] = ["total", report["rows"].sum(), *report.iloc[:, 2:].sum(min_count = 1)]
+
+        return report
+
+    @classmethod
+    def clear_cache(cls):
+        """
+        Drops every dataset kept in memory, so that the next retrieval reads the csv files again
+        """
+        with cls._lock:
+            cls._cache.clear()
@@ -0,0 +1,96 @@
+"""
+This script builds the fact table of my Olist project: a row per order item, with the
+codes of its order, product and seller (see olist_scripts.keys) as foreign keys to the
+dimension tables, and its measures. The reviews, which are per order rather
+than per item, are reduced per order once as well.
+
+The per product and per seller features are grouped reductions over these, instead of
+each of them joining orders, items, reviews and products or sellers into a wide df and
+dropping the duplicates that join explodes into.
+"""
+
+import numpy as np
+import pandas as pd
+from olist_scripts.data import get_derived
+from olist_scripts.keys import get_dictionary, get_encoded
+
+
+def build_order_item_facts(data) -> pd.DataFrame:
+    """
+    Returns a df with a row per order item and the codes of its order_id, product_id and
+    seller_id, its order_item_id, price and freight_value, and whether its order is in
+    orders_df (known_order).
+
+    The items are in the order of orders_df, and within an order in the order of
+    order_items_df, like in a join of orders_df with order_items_df. The items of unknown
+    orders come last.
+    """
+    orders = get_encoded(data, "orders_df", columns = ["order_id"])
+    items = get_encoded(data, "order_items_df", columns = ["order_id", "order_item_id", "product_id", "seller_id",
+                                                           "price", "freight_value"])
+
+    known = orders.merge(items, on = "order_id")
+    unknown = items[~items["order_id"].isin(orders["order_id"])]
+
+    facts = pd.concat([known.assign(known_order = True), unknown.assign(known_order = False)], ignore_index = True)
+
+    return facts[["order_id", "product_id", "seller_id", "order_item_id", "price", "freight_value", "known_order"]]
+
+
+def get_order_item_facts(data) -> pd.DataFrame:
+    """
+    Returns the order item facts of data, built once and then shared. It should be
+    copied before being modified.
+    """
+    return get_derived(data, "order_item_facts", build_order_item_facts)
+
+
+def build_order_review_stats(data) -> pd.DataFrame:
+    """
+    Returns a df indexed by order code (every order_id of the dictionary), with the number
+    of reviews of the order (n_reviews), how many are 1 and 5 stars (one_star, five_star),
+    the sum and count of their scores (score_sum, score_count), and the score of the
+    first review of the order (first_score, as in Order.get_reviews), NaN without one.
+    """
+    reviews = get_encoded(data, "order_reviews_df", columns = ["order_id", "review_score"])
+    n_orders = len(get_dictionary(data, "order_id"))
+
+    codes = reviews["order_id"].to_numpy()
+    scores = reviews["review_score"].to_numpy(dtype = np.float64, na_value = np.nan)
+    has_order = codes >= 0
+    codes, scores = codes[has_order], scores[has_order]
+
+    def count(weights = None):
+        return np.bincount(codes, weights = weights, minlength = n_orders)
+
+    first_score = np.full(n_orders, np.nan)
+    (reviewed, first) = np.unique(codes, return_index = True)
+    first_score[reviewed] = scores[first]
+
+    scored = ~np.isnan(scores)
+
+    return pd.DataFrame({"n_reviews": count().astype(np.int64),
+                         "one_star": count(scores == 1).astype(np.int64),
+                         "five_star": count(scores == 5).astype(np.int64),
+                         "score_sum": count(np.where(scored, scores, 0)),
+                         "score_count": count(scored).astype(np.int64),
+                         "first_score": first_score})
+
+
+def get_order_review_stats(data) -> pd.DataFrame:
+    """
+    Returns the per order review reductions of data, built once and then shared. It
+    should be copied before being modified.
+    """
+    return get_derived(data, "order_review_stats", build_order_review_stats)
+
+
+def get_first_pairs(first, second) -> np.ndarray:
+    """
+    Returns the positions of the first occurrence of every distinct (first, second) pair
+    of codes (non negative, or -1 for missing ones), in order
+    """
+    first, second = np.asarray(first, dtype = np.int64), np.asarray(second, dtype = np.int64)
+    pairs = first*(second.max(initial = 0) + 2) + (second + 1)
+
+    return np.sort(np.unique(pairs, return_index = True)[1])
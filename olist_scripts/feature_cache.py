@@ -0,0 +1,270 @@
+"""
+This script keeps the outputs of the get_* methods of Order, Product, Seller and Review
+on disk for my Olist project, so that a notebook session or a job does not compute the
+features again when neither the data nor the code changed since they were last computed.
+
+Every output is keyed by the fingerprint of the tables the method reads, its arguments
+and a version of the feature code (a hash of the olist_scripts sources, together with
+FEATURE_CACHE_VERSION), and written as an Arrow IPC file next to the snapshots, e.g.
+data/.snapshots/features/Order.get_training_data-<key>.arrow. Hits are memory-mapped
+rather than computed again. The least recently used outputs are evicted once the cache
+grows beyond its size.
+
+The cache is on whenever the snapshots are, unless it is turned off with
+Olist(feature_cache = False) or by setting the environment variable OLIST_FEATURE_CACHE
+to 0. OLIST_FEATURE_CACHE_SIZE sets its size in MB (1024 by default).
+"""
+
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+import threading
+import pyarrow as pa
+import pandas as pd
+from olist_scripts.snapshot import STRING_TYPES
+from olist_scripts.sql import get_sqlite
+
+# bumped whenever the features change in a way the sources do not show, e.g. a dependency upgrade
+FEATURE_CACHE_VERSION = 1
+
+FEATURE_CACHE_DIR_NAME = "features"
+FEATURE_CACHE_SIZE = 1024*2**20
+
+# arguments that change how an output is computed but not the output itself
+IGNORED_ARGUMENTS = ["executor"]
+
+_code_version = None
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_code_version() -> str:
+    """
+    Returns a short hash of FEATURE_CACHE_VERSION and of the sources of olist_scripts,
+    computed once per process
+    """
+    global _code_version
+
+    if _code_version is None:
+        digest = hashlib.sha1(str(FEATURE_CACHE_VERSION).encode())
+        for path in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "*.py"))):
+            with open(path, "rb") as file:
+                digest.update(file.read())
+
+        _code_version = digest.hexdigest()[:16]
+
+    return _code_version
+
+
+class FeatureCache:
+    """
+    The cached outputs in cache_dir, at most max_bytes of them. Every output is a file
+    named after the method and its key, whose modification time is when it was last
+    used, so that processes sharing the directory share the same LRU order.
+    """
+
+    def __init__(self, cache_dir, max_bytes = FEATURE_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, name, key) -> str:
+        return os.path.join(self.cache_dir, f"{name}-{key}.arrow")
+
+    def get(self, name, key):
+        """
+        Returns the cached output of name with key as a df, memory-mapped, or None on a miss
+        """
+        path = self.get_path(name, key)
+
+        try:
+            with pa.memory_map(path) as source:
+                table = pa.ipc.open_file(source).read_all()
+        except (FileNotFoundError, pa.ArrowInvalid):
+            self.misses += 1
+            return None
+
+        # marking it as just used, which a read-only cache cannot
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        self.hits += 1
+
+        return table.to_pandas(types_mapper = STRING_TYPES.get)
+
+    def put(self, name, key, df):
+        """
+        Writes df as the output of name with key, under a temporary name first so that
+        readers never see half of it, and evicts the least recently used outputs if
+        the cache has grown too large. Outputs Arrow cannot hold, or that cannot be
+        written, are not cached.
+        """
+        try:
+            table = pa.Table.from_pandas(df)
+        except (pa.ArrowException, TypeError, ValueError):
+            return
+
+        path = self.get_path(name, key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok = True)
+            with pa.OSFile(temp_path, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+
+            os.replace(temp_path, path)
+        except OSError:
+            # a cache that cannot be written only means that the outputs are computed again
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        self.evict()
+
+    def get_entries(self) -> pd.DataFrame:
+        """
+        Returns a df with the name, key, path, size and last use of every cached output,
+        least recently used first
+        """
+        rows = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*.arrow")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            name, key = os.path.basename(path)[:-len(".arrow")].rsplit("-", 1)
+            rows.append({"name": name, "key": key, "path": path, "size": stat.st_size,
+                         "last_used": pd.Timestamp(stat.st_mtime_ns)})
+
+        df = pd.DataFrame(rows, columns = ["name", "key", "path", "size", "last_used"])
+
+        return df.sort_values("last_used", ignore_index = True)
+
+    def evict(self):
+        """
+        Removes the least recently used outputs until the cache fits in max_bytes
+        """
+        entries = self.get_entries()
+        excess = entries["size"].sum() - self.max_bytes
+
+        for (path, size) in zip(entries["path"], entries["size"]):
+            if excess <= 0:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            excess -= size
+
+    def invalidate(self, name = None):
+        """
+        Removes every cached output of name (e.g. "Order.get_training_data", or "Order"
+        for all of its methods), or every output if name is None
+        """
+        for path in glob.glob(os.path.join(self.cache_dir, "*.arrow")):
+            output_name = os.path.basename(path).rsplit("-", 1)[0]
+
+            if name is None or output_name == name or output_name.startswith(f"{name}."):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        """
+        Removes every cached output
+        """
+        self.invalidate()
+
+
+def get_feature_cache(data):
+    """
+    Returns the feature cache of data, or None if it has none: plain dictionaries of
+    dataframes have no fingerprint, and the cache is off without snapshots, with
+    Olist(feature_cache = False) or with OLIST_FEATURE_CACHE=0
+    """
+    olist = getattr(data, "olist", None)
+    if olist is None or not (olist.use_snapshots and olist.feature_cache) \
+            or os.environ.get("OLIST_FEATURE_CACHE", "1") == "0":
+        return None
+
+    cache_dir = os.path.join(olist.snapshot_dir, FEATURE_CACHE_DIR_NAME)
+    max_bytes = int(float(os.environ.get("OLIST_FEATURE_CACHE_SIZE", FEATURE_CACHE_SIZE/2**20))*2**20)
+
+    with _caches_lock:
+        if (cache_dir, max_bytes) not in _caches:
+            _caches[(cache_dir, max_bytes)] = FeatureCache(cache_dir, max_bytes)
+
+    return _caches[(cache_dir, max_bytes)]
+
+
+def get_cache_key(data, method, arguments) -> str:
+    """
+    Returns the key of the output of method for data and the (bound) arguments
+    """
+    # only the tables the method reads count, or all of them if it does not declare them
+    tables = getattr(method, "tables", None)
+    fingerprint = [entry for entry in data.fingerprint
+                   if tables is None or os.path.splitext(entry[0])[0] + "_df" in tables]
+
+    # outputs aggregated by sqlite (backend = "sqlite") also depend on the sqlite file, opened
+    # first since creating its indexes modifies it
+    if arguments.get("backend") == "sqlite":
+        sqlite_file = get_sqlite(data).path
+        stat = os.stat(sqlite_file)
+        fingerprint.append((sqlite_file, stat.st_mtime_ns, stat.st_size))
+
+    source = json.dumps([get_code_version(), data.olist.csv_path, data.olist.backend, fingerprint,
+                         data.columns, arguments], sort_keys = True, default = repr)
+
+    return hashlib.sha1(source.encode()).hexdigest()[:16]
+
+
+def _wrap(cls_name, method):
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = get_feature_cache(self.data)
+        if cache is None:
+            return method(self, *args, **kwargs)
+
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        arguments = {name: value for (name, value) in list(bound.arguments.items())[1:]
+                     if name not in IGNORED_ARGUMENTS}
+
+        name = f"{cls_name}.{method.__name__}"
+        key = get_cache_key(self.data, method, arguments)
+
+        df = cache.get(name, key)
+        if df is None:
+            df = method(self, *args, **kwargs)
+
+            # only dataframes are cached, e.g. sparse matrices are always computed
+            if isinstance(df, pd.DataFrame):
+                cache.put(name, key, df)
+
+        return df
+
+    return wrapper
+
+
+def cached(cls):
+    """
+    Class decorator that caches the output of every get_* method of cls on disk
+    """
+    for (name, method) in list(vars(cls).items()):
+        if name.startswith("get_") and callable(method):
+            setattr(cls, name, _wrap(cls.__name__, method))
+
+    return cls
@@ -0,0 +1,361 @@
+"""
+This script contains the geolocation index of my Olist project. It averages the
+coordinates of every zip code prefix once, and then computes distances between
+sellers and customers by looking up their prefixes directly in arrays.
+
+Sellers and customers whose prefix is not in the geolocation table get the coordinates
+of the numerically closest prefix of the same sector (the same first 3 digits), or
+else the mean coordinates of their city, or else of their state. A k-d tree over the
+sellers then answers nearest neighbour and radius queries for many customers at once.
+"""
+
+import threading
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from olist_scripts.data import get_derived
+from olist_scripts.text import normalize_text
+
+# same earth radius as the haversine package uses for kilometers
+EARTH_RADIUS_KM = 6371.0088
+
+# zip code prefixes have 5 digits, so a dense table indexed by the prefix stays small
+ZIP_TABLE_SIZE = 100_000
+
+# prefixes with the same prefix // ZIP_SECTOR (their first 3 digits) are in the same sector
+ZIP_SECTOR = 100
+
+# where the coordinates of a seller or customer come from, -1 if nowhere
+IMPUTATION_LEVELS = ["zip", "sector", "city", "state"]
+
+
+def haversine_km(lat_1, lng_1, lat_2, lng_2) -> np.ndarray:
+    """
+    Returns the great circle distances (in km) between the points (lat_1, lng_1) and
+    (lat_2, lng_2), element-wise over arrays of degrees. NaN coordinates give NaN.
+    """
+    lat_1, lng_1, lat_2, lng_2 = (np.radians(np.asarray(x, dtype = np.float64)) \
+                                  for x in (lat_1, lng_1, lat_2, lng_2))
+
+    a = np.sin((lat_2 - lat_1)/2)**2 + np.cos(lat_1)*np.cos(lat_2)*np.sin((lng_2 - lng_1)/2)**2
+
+    return 2*EARTH_RADIUS_KM*np.arcsin(np.sqrt(a))
+
+
+def to_unit_vectors(lat, lng) -> np.ndarray:
+    """
+    Returns the points (in degrees) as 3d unit vectors, an (n, 3) array
+    """
+    lat, lng = np.radians(np.asarray(lat, dtype = np.float64)), np.radians(np.asarray(lng, dtype = np.float64))
+
+    return np.column_stack([np.cos(lat)*np.cos(lng), np.cos(lat)*np.sin(lng), np.sin(lat)])
+
+
+def chord_to_km(chord) -> np.ndarray:
+    return 2*EARTH_RADIUS_KM*np.arcsin(np.minimum(np.asarray(chord)/2, 1))
+
+
+def km_to_chord(distance_km) -> float:
+    return 2*np.sin(min(distance_km/(2*EARTH_RADIUS_KM), np.pi/2))
+
+
+def normalize_places(places) -> np.ndarray:
+    """
+    Returns the city (or state) names normalized like olist_scripts.text.normalize_text
+    does (e.g. "São Paulo" becomes "sao paulo"), as an object array with None for
+    missing names. Only the distinct names are normalized.
+    """
+    codes, names = pd.factorize(pd.Series(places))
+    names = np.array(normalize_text(np.asarray(names, dtype = object)).to_pylist() + [None], dtype = object)
+
+    return names[codes]
+
+
+class SpatialIndex:
+    """
+    A k-d tree over points on the earth, kept as 3d unit vectors, whose straight line
+    (chord) distances are in the same order as their great circle distances. Points
+    without coordinates are left out, positions refer to the points given.
+    """
+
+    def __init__(self, lat, lng):
+        lat, lng = np.asarray(lat, dtype = np.float64), np.asarray(lng, dtype = np.float64)
+
+        self.positions = np.flatnonzero(np.isfinite(lat) & np.isfinite(lng))
+        self.tree = cKDTree(to_unit_vectors(lat[self.positions], lng[self.positions]))
+
+    def query_nearest(self, lat, lng, k = 1) -> tuple:
+        """
+        Returns the distances (in km) and positions of the k nearest points of every
+        query point, (n, k) arrays sorted by distance. Missing neighbours (or query
+        points without coordinates) have an infinite distance and a position of -1.
+        """
+        lat, lng = np.asarray(lat, dtype = np.float64), np.asarray(lng, dtype = np.float64)
+        known = np.isfinite(lat) & np.isfinite(lng)
+
+        distances = np.full((len(lat), k), np.inf)
+        positions = np.full((len(lat), k), -1, dtype = np.int64)
+
+        if known.any() and len(self.positions):
+            chords, found = self.tree.query(to_unit_vectors(lat[known], lng[known]), k = k)
+            chords, found = chords.reshape(-1, k), found.reshape(-1, k)
+
+            # the tree marks missing neighbours with its number of points
+            missing = found >= len(self.positions)
+            distances[known] = np.where(missing, np.inf, chord_to_km(chords))
+            positions[known] = np.where(missing, -1, self.positions[np.minimum(found, len(self.positions) - 1)])
+
+        return distances, positions
+
+    def query_radius(self, lat, lng, radius_km) -> tuple:
+        """
+        Returns every pair of a query point and a point within radius_km of it, as the
+        arrays of their positions and of their distances (in km)
+        """
+        lat, lng = np.asarray(lat, dtype = np.float64), np.asarray(lng, dtype = np.float64)
+        queries = np.flatnonzero(np.isfinite(lat) & np.isfinite(lng))
+
+        # pairing the points of two trees at once is much faster than a query per point
+        query_tree = cKDTree(to_unit_vectors(lat[queries], lng[queries]))
+        pairs = query_tree.sparse_distance_matrix(self.tree, km_to_chord(radius_km), output_type = "ndarray")
+
+        return queries[pairs["i"]], self.positions[pairs["j"]], chord_to_km(pairs["v"])
+
+    def count_within(self, lat, lng, radius_km) -> np.ndarray:
+        """
+        Returns the number of points within radius_km of every query point
+        """
+        lat, lng = np.asarray(lat, dtype = np.float64), np.asarray(lng, dtype = np.float64)
+        known = np.isfinite(lat) & np.isfinite(lng)
+
+        counts = np.zeros(len(lat), dtype = np.int64)
+        if known.any():
+            counts[known] = self.tree.query_ball_point(to_unit_vectors(lat[known], lng[known]),
+                                                       km_to_chord(radius_km), return_length = True)
+
+        return counts
+
+
+class GeoIndex:
+    """
+    Mean coordinates per zip code prefix, kept both as sorted arrays (zips, lat, lng)
+    and as dense tables indexed by the prefix itself, and per city and state. Also
+    knows the coordinates of every seller and customer, imputed where their prefix is
+    missing, to compute distances between them by their ids.
+    """
+
+    def __init__(self, geolocation, sellers, customers):
+        zip_codes = geolocation["geolocation_zip_code_prefix"].to_numpy(dtype = np.int64)
+        size = max(ZIP_TABLE_SIZE, int(zip_codes.max(initial = 0)) + 1)
+
+        # averaging lat and long for each zip code, with one pass over the geolocation rows
+        counts = np.bincount(zip_codes, minlength = size)
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            self.lat_table = np.bincount(zip_codes, weights = geolocation["geolocation_lat"].to_numpy(),
+                                         minlength = size)/counts
+            self.lng_table = np.bincount(zip_codes, weights = geolocation["geolocation_lng"].to_numpy(),
+                                         minlength = size)/counts
+
+        self.zips = np.flatnonzero(counts)
+        self.lat = self.lat_table[self.zips]
+        self.lng = self.lng_table[self.zips]
+
+        # averaging lat and long for each city (within its state) and each state
+        places = pd.DataFrame({"city": normalize_places(geolocation["geolocation_city"]),
+                               "state": normalize_places(geolocation["geolocation_state"]),
+                               "lat": geolocation["geolocation_lat"].to_numpy(),
+                               "lng": geolocation["geolocation_lng"].to_numpy()})
+        self.city_coordinates = places.groupby(["city", "state"])[["lat", "lng"]].mean()
+        self.state_coordinates = places.groupby("state")[["lat", "lng"]].mean()
+
+        self.seller_ids = pd.Index(sellers["seller_id"])
+        self.seller_zips = sellers["seller_zip_code_prefix"].to_numpy(dtype = np.int64)
+        self.seller_lat, self.seller_lng, self.seller_levels = self.impute_coordinates(
+            self.seller_zips, sellers["seller_city"], sellers["seller_state"])
+
+        self.customer_ids = pd.Index(customers["customer_id"])
+        self.customer_zips = customers["customer_zip_code_prefix"].to_numpy(dtype = np.int64)
+        self.customer_lat, self.customer_lng, self.customer_levels = self.impute_coordinates(
+            self.customer_zips, customers["customer_city"], customers["customer_state"])
+
+        self._seller_index = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        Builds the index from the geolocation, sellers and customers tables of data
+        """
+        return cls(data["geolocation_df"], data["sellers_df"], data["customers_df"])
+
+    def get_coordinates(self, zip_prefixes) -> tuple:
+        """
+        Returns the (lat, lng) arrays for the given zip prefixes, NaN for unknown prefixes
+        """
+        zip_prefixes = np.asarray(zip_prefixes, dtype = np.float64)
+
+        known = np.isfinite(zip_prefixes) & (zip_prefixes >= 0) & (zip_prefixes < self.lat_table.size)
+        positions = np.where(known, zip_prefixes, 0).astype(np.int64)
+
+        lat = np.where(known, self.lat_table[positions], np.nan)
+        lng = np.where(known, self.lng_table[positions], np.nan)
+
+        return lat, lng
+
+    def get_sector_neighbours(self, zip_prefixes) -> np.ndarray:
+        """
+        Returns the known prefix numerically closest to every prefix (the lower one on
+        ties) within the same sector, NaN if the sector has none
+        """
+        zip_prefixes = np.asarray(zip_prefixes, dtype = np.float64)
+        if len(self.zips) == 0:
+            return np.full(len(zip_prefixes), np.nan)
+
+        known = np.isfinite(zip_prefixes)
+        prefixes = np.where(known, zip_prefixes, 0).astype(np.int64)
+
+        after = np.searchsorted(self.zips, prefixes)
+        above = self.zips[np.minimum(after, len(self.zips) - 1)]
+        below = self.zips[np.maximum(after - 1, 0)]
+
+        closest = np.where(np.abs(above - prefixes) < np.abs(prefixes - below), above, below)
+        same_sector = known & (closest//ZIP_SECTOR == prefixes//ZIP_SECTOR)
+
+        return np.where(same_sector, closest, np.nan)
+
+    def impute_coordinates(self, zip_prefixes, cities = None, states = None) -> tuple:
+        """
+        Returns the (lat, lng) arrays for the given zip prefixes, with the coordinates of
+        the closest prefix in the same sector for unknown prefixes, or else those of their
+        city and state, or else of their state. Also returns where every coordinate comes
+        from, as positions in IMPUTATION_LEVELS (-1 for none).
+        """
+        lat, lng = self.get_coordinates(zip_prefixes)
+        levels = np.where(np.isfinite(lat), 0, -1)
+
+        def fill(level, positions, coordinates):
+            found = (levels < 0) & (positions >= 0)
+            lat[found] = coordinates["lat"].to_numpy()[positions[found]]
+            lng[found] = coordinates["lng"].to_numpy()[positions[found]]
+            levels[found] = level
+
+        neighbours = self.get_sector_neighbours(zip_prefixes)
+        has_neighbour = (levels < 0) & np.isfinite(neighbours)
+        lat[has_neighbour], lng[has_neighbour] = self.get_coordinates(neighbours[has_neighbour])
+        levels[has_neighbour] = 1
+
+        if states is not None and (levels < 0).any():
+            states = normalize_places(states)
+
+            if cities is not None:
+                cities = normalize_places(cities)
+                fill(2, self.city_coordinates.index.get_indexer(pd.MultiIndex.from_arrays([cities, states])),
+                     self.city_coordinates)
+
+            fill(3, self.state_coordinates.index.get_indexer(states), self.state_coordinates)
+
+        return lat, lng, levels
+
+    def _get_zips(self, ids, id_index, zips) -> np.ndarray:
+        """
+        Returns the zip prefixes (as floats, NaN if unknown) of the given ids
+        """
+        positions = id_index.get_indexer(ids)
+
+        return np.where(positions >= 0, zips[positions], np.nan)
+
+    def _get_imputed(self, ids, id_index, lat, lng) -> tuple:
+        """
+        Returns the imputed (lat, lng) arrays of the given ids, NaN for unknown ids
+        """
+        positions = id_index.get_indexer(ids)
+        known = positions >= 0
+
+        return np.where(known, lat[positions], np.nan), np.where(known, lng[positions], np.nan)
+
+    def get_seller_coordinates(self, seller_ids, impute = False) -> tuple:
+        """
+        Returns the (lat, lng) arrays of the given sellers' zip prefixes, imputed for
+        missing prefixes if impute is True (see impute_coordinates)
+        """
+        if impute:
+            return self._get_imputed(seller_ids, self.seller_ids, self.seller_lat, self.seller_lng)
+
+        return self.get_coordinates(self._get_zips(seller_ids, self.seller_ids, self.seller_zips))
+
+    def get_customer_coordinates(self, customer_ids, impute = False) -> tuple:
+        """
+        Returns the (lat, lng) arrays of the given customers' zip prefixes, imputed for
+        missing prefixes if impute is True (see impute_coordinates)
+        """
+        if impute:
+            return self._get_imputed(customer_ids, self.customer_ids, self.customer_lat, self.customer_lng)
+
+        return self.get_coordinates(self._get_zips(customer_ids, self.customer_ids, self.customer_zips))
+
+    def distance(self, seller_ids, customer_ids, impute = False) -> np.ndarray:
+        """
+        Returns the distances (in km) between each seller and the customer at the
+        same position, NaN where either of their zip prefixes has no coordinates
+        (or none could be imputed, if impute is True).
+        """
+        seller_lat, seller_lng = self.get_seller_coordinates(seller_ids, impute)
+        customer_lat, customer_lng = self.get_customer_coordinates(customer_ids, impute)
+
+        return haversine_km(seller_lat, seller_lng, customer_lat, customer_lng)
+
+    def get_seller_index(self) -> SpatialIndex:
+        """
+        Returns the spatial index of the (imputed) coordinates of every seller, built once
+        """
+        with self._lock:
+            if self._seller_index is None:
+                self._seller_index = SpatialIndex(self.seller_lat, self.seller_lng)
+
+        return self._seller_index
+
+    def get_nearest_sellers(self, customer_ids, k = 1) -> pd.DataFrame:
+        """
+        Returns a df with the k nearest sellers of every customer, with their rank (1 for
+        the nearest) and distance_km
+        """
+        customer_ids = pd.Series(customer_ids)
+        distances, positions = self.get_seller_index().query_nearest(
+            *self.get_customer_coordinates(customer_ids, impute = True), k = k)
+
+        found = positions >= 0
+        rows, ranks = np.nonzero(found)
+
+        return pd.DataFrame({"customer_id": customer_ids.array[rows],
+                             "seller_id": self.seller_ids.array[positions[found]],
+                             "rank": ranks + 1,
+                             "distance_km": distances[found]})
+
+    def get_sellers_within(self, customer_ids, radius_km) -> pd.DataFrame:
+        """
+        Returns a df with every customer and seller within radius_km of each other, and
+        their distance_km, sorted by customer (in the order of customer_ids) and distance
+        """
+        customer_ids = pd.Series(customer_ids)
+        queries, positions, distances = self.get_seller_index().query_radius(
+            *self.get_customer_coordinates(customer_ids, impute = True), radius_km)
+
+        order = np.lexsort((distances, queries))
+
+        return pd.DataFrame({"customer_id": customer_ids.array[queries[order]],
+                             "seller_id": self.seller_ids.array[positions[order]],
+                             "distance_km": distances[order]})
+
+    def count_sellers_within(self, customer_ids, radius_km) -> np.ndarray:
+        """
+        Returns the number of sellers within radius_km of every customer
+        """
+        return self.get_seller_index().count_within(*self.get_customer_coordinates(customer_ids, impute = True),
+                                                    radius_km)
+
+
+def get_geo_index(data) -> GeoIndex:
+    """
+    Returns the GeoIndex of data, built once and then shared
+    """
+    return get_derived(data, "geo_index", GeoIndex.from_data)
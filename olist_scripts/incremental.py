@@ -0,0 +1,309 @@
+"""
+This script keeps the per seller and per product aggregates of my Olist project up to
+date while new orders, items and reviews keep arriving, without recomputing them from
+scratch. It gives the same results as Seller.get_quantitative_features,
+Seller.get_review_score, Seller.get_active_dates and Product.get_sales_features.
+
+Every aggregate is a sum of per order contributions (or a min/max over them), so
+appending rows only needs the contributions of the orders those rows belong to: their
+old contribution is subtracted, and their new one is added.
+"""
+
+import numpy as np
+import pandas as pd
+
+SELLER_SUMS = ["order_count", "total_items_sold", "revenue", "review_rows", "one_star",
+               "five_star", "score_sum", "score_count"]
+SELLER_DATES = ["first_order", "last_order"]
+PRODUCT_SUMS = ["n_orders", "n_items_sold", "price_sum", "price_count"]
+
+ORDER_COLUMNS = ["order_id", "order_purchase_timestamp"]
+ITEM_COLUMNS = ["order_id", "order_item_id", "product_id", "seller_id", "price"]
+REVIEW_COLUMNS = ["order_id", "review_score"]
+
+# once a table has this many appended chunks, they are merged into one
+MAX_CHUNKS = 16
+
+
+class OrderKeyedTable:
+    """
+    Append-only table kept as a list of chunks sorted by order_id, so that the rows of
+    a few orders can be found by binary search without scanning the whole table.
+    """
+
+    def __init__(self, df, columns):
+        self.columns = columns
+        self.chunks = []
+        self.keys = []
+        self.append(df)
+
+    def append(self, df):
+        if df is None or len(df) == 0:
+            return
+
+        chunks = self.chunks + [df[self.columns]]
+        if len(chunks) > MAX_CHUNKS:
+            chunks = [pd.concat(chunks)]
+            self.chunks, self.keys = [], []
+
+        # keeping the keys as fixed width strings, which numpy compares much faster than objects
+        chunk = chunks[-1]
+        keys = chunk["order_id"].to_numpy(dtype = str)
+        order = np.argsort(keys, kind = "stable")
+
+        self.chunks.append(chunk.iloc[order].reset_index(drop = True))
+        self.keys.append(keys[order])
+
+    def rows(self, order_ids) -> pd.DataFrame:
+        """
+        Returns all the rows of the given orders
+        """
+        order_ids = np.asarray(order_ids, dtype = str)
+
+        found = []
+        for (chunk, keys) in zip(self.chunks, self.keys):
+            # every order id matches the rows from its left to its right insertion point
+            left = np.searchsorted(keys, order_ids, side = "left")
+            lengths = np.searchsorted(keys, order_ids, side = "right") - left
+            positions = np.repeat(left - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            found.append(chunk.iloc[positions])
+
+        if not found:
+            return pd.DataFrame(columns = self.columns)
+
+        return pd.concat(found, ignore_index = True)
+
+
+def get_contributions(orders, items, reviews) -> tuple:
+    """
+    Returns the partial aggregates (per seller, per product) of the given orders, items
+    and reviews, which should contain every row of the orders they refer to.
+    """
+    # seller aggregates only count the items of known orders, like the joins starting from orders_df
+    sold = orders[ORDER_COLUMNS].merge(items[ITEM_COLUMNS], on = "order_id")
+
+    quantitative = sold.groupby("seller_id").agg(order_count = ("order_id", "nunique"),
+                                                 total_items_sold = ("order_item_id", "sum"),
+                                                 revenue = ("price", "sum"),
+                                                 first_order = ("order_purchase_timestamp", "min"),
+                                                 last_order = ("order_purchase_timestamp", "max"))
+
+    reviewed = orders[["order_id"]].merge(reviews[REVIEW_COLUMNS], on = "order_id", how = "left") \
+        .merge(items[["order_id", "seller_id"]], on = "order_id")
+    reviewed["one_star"] = (reviewed["review_score"] == 1).astype(int)
+    reviewed["five_star"] = (reviewed["review_score"] == 5).astype(int)
+
+    review = reviewed.groupby("seller_id").agg(review_rows = ("order_id", "count"),
+                                               one_star = ("one_star", "sum"),
+                                               five_star = ("five_star", "sum"),
+                                               score_sum = ("review_score", "sum"),
+                                               score_count = ("review_score", "count"))
+
+    sellers = quantitative.join(review, how = "outer")
+    sellers[SELLER_SUMS] = sellers[SELLER_SUMS].astype(float).fillna(0)
+
+    # product aggregates count every item, like the join starting from products_df
+    products = items.groupby("product_id").agg(n_orders = ("order_id", "nunique"),
+                                               n_items_sold = ("order_item_id", "count"),
+                                               price_sum = ("price", "sum"),
+                                               price_count = ("price", "count")).astype(float)
+
+    return sellers, products
+
+
+def update_partials(partials, new, old, sum_columns, min_columns = (), max_columns = ()) -> pd.DataFrame:
+    """
+    Returns partials with the sums of old subtracted and those of new added, in place
+    for the keys already in partials. The min/max columns are merged with new.
+    """
+    keys = new.index.union(old.index)
+    missing = keys.difference(partials.index)
+
+    if len(missing):
+        empty = pd.DataFrame(index = missing, columns = partials.columns).astype(partials.dtypes.to_dict())
+        empty[sum_columns] = 0.0
+        partials = pd.concat([partials, empty])
+
+    delta = new[sum_columns].reindex(keys, fill_value = 0) - old[sum_columns].reindex(keys, fill_value = 0)
+    partials.loc[keys, sum_columns] += delta.to_numpy()
+
+    for column in min_columns:
+        partials.loc[new.index, column] = pd.concat([partials.loc[new.index, column], new[column]],
+                                                    axis = 1).min(axis = 1)
+    for column in max_columns:
+        partials.loc[new.index, column] = pd.concat([partials.loc[new.index, column], new[column]],
+                                                    axis = 1).max(axis = 1)
+
+    return partials
+
+
+class PartialAggregates:
+    """
+    Per seller and per product partial aggregates (sums, counts and first/last order
+    dates), from which the seller and product features are computed. Partials of
+    disjoint sets of orders are combined with combine().
+    """
+
+    def __init__(self, seller_partials, product_partials, product_ids):
+        self.seller_partials = seller_partials
+        self.product_partials = product_partials
+        self.product_ids = [product_ids]
+
+    def combine(self, seller_partials, product_partials):
+        """
+        Adds the partials of orders that were not included so far
+        """
+        empty_sellers = seller_partials.iloc[:0]
+        empty_products = product_partials.iloc[:0]
+
+        self.seller_partials = update_partials(self.seller_partials, seller_partials, empty_sellers, SELLER_SUMS,
+                                               ["first_order"], ["last_order"])
+        self.product_partials = update_partials(self.product_partials, product_partials, empty_products,
+                                                PRODUCT_SUMS)
+
+    def _get_sellers(self) -> pd.DataFrame:
+        sellers = self.seller_partials[self.seller_partials["order_count"] > 0].sort_index()
+        sellers.index.name = "seller_id"
+
+        return sellers
+
+    def get_quantitative_features(self) -> pd.DataFrame:
+        """
+        Same as Seller.get_quantitative_features, sorted by seller_id
+        """
+        df = self._get_sellers()[["order_count", "total_items_sold", "revenue"]].reset_index()
+        df["order_count"] = df["order_count"].astype(np.int64)
+
+        df["items_per_order"] = df["total_items_sold"]/df["order_count"]
+        df["revenue_per_order"] = df["revenue"]/df["order_count"]
+
+        return df
+
+    def get_review_score(self) -> pd.DataFrame:
+        """
+        Same as Seller.get_review_score, sorted by seller_id
+        """
+        sellers = self._get_sellers()
+
+        df = sellers[["one_star", "five_star"]].astype(np.int64)
+        df["review_score"] = sellers["score_sum"]/sellers["score_count"]
+        df["order_count"] = sellers["review_rows"].astype(np.int64)
+
+        df["share_of_one_stars"] = df["one_star"]/df["order_count"]
+        df["share_of_five_stars"] = df["five_star"]/df["order_count"]
+
+        return df.reset_index()
+
+    def get_active_dates(self) -> pd.DataFrame:
+        """
+        Same as Seller.get_active_dates, sorted by seller_id
+        """
+        df = self._get_sellers()[SELLER_DATES].reset_index()
+
+        df["months_on_olist"] = round((df["last_order"] - df["first_order"])/pd.Timedelta(days = 30) + 1)
+
+        return df
+
+    def get_sales_features(self) -> pd.DataFrame:
+        """
+        Same as Product.get_sales_features
+        """
+        product_ids = pd.Index(pd.concat(self.product_ids).unique(), name = "product_id").sort_values()
+        products = self.product_partials.reindex(product_ids)
+
+        df = products[["n_orders", "n_items_sold"]].fillna(0).astype(np.int64)
+        df["mean_price"] = products["price_sum"]/products["price_count"]
+        df["total_revenue"] = df["n_orders"]*df["mean_price"]
+
+        return df.reset_index()
+
+    def check(self, data):
+        """
+        Recomputes the aggregates from scratch with Seller and Product on data, and
+        raises an AssertionError if they differ from these ones.
+        """
+        # importing here, since those modules are heavier and only needed for checking
+        from olist_scripts.product import Product
+        from olist_scripts.seller import Seller
+
+        seller, product = Seller(data), Product(data)
+        pairs = [(self.get_quantitative_features(), seller.get_quantitative_features()),
+                 (self.get_review_score(), seller.get_review_score()),
+                 (self.get_active_dates(), seller.get_active_dates()),
+                 (self.get_sales_features(), product.get_sales_features())]
+
+        for (partial, full) in pairs:
+            full = full[partial.columns].sort_values("product_id" if "product_id" in full else "seller_id")
+
+            pd.testing.assert_frame_equal(partial.reset_index(drop = True), full.reset_index(drop = True),
+                                          check_dtype = False, check_index_type = False)
+
+
+class IncrementalAggregates(PartialAggregates):
+    """
+    Per seller and per product partial aggregates that are updated as new orders,
+    order items and reviews are appended, in time proportional to the appended rows.
+
+    With verify = True, every append is followed by a full recompute with Seller and
+    Product, and an AssertionError is raised if the results differ. That keeps a copy
+    of all the data, so it is meant for testing.
+    """
+
+    def __init__(self, data, verify = False):
+        self.verify = verify
+
+        self.orders = OrderKeyedTable(data["orders_df"], ORDER_COLUMNS)
+        self.items = OrderKeyedTable(data["order_items_df"], ITEM_COLUMNS)
+        self.reviews = OrderKeyedTable(data["order_reviews_df"], REVIEW_COLUMNS)
+
+        super().__init__(*get_contributions(data["orders_df"], data["order_items_df"], data["order_reviews_df"]),
+                         data["products_df"]["product_id"])
+
+        if verify:
+            self.history = {key: [data[key]] for key in ["orders_df", "order_items_df", "order_reviews_df",
+                                                        "products_df", "sellers_df"]}
+            self.check()
+
+    def append(self, orders = None, order_items = None, order_reviews = None, products = None, sellers = None):
+        """
+        Adds newly arrived rows (with the columns of the corresponding olist tables) and
+        updates the aggregates. Rows may refer to orders that already exist, e.g. a late
+        review or an item added to an order.
+        """
+        deltas = [df for df in (orders, order_items, order_reviews) if df is not None]
+        order_ids = pd.unique(pd.concat([df["order_id"] for df in deltas]).to_numpy()) if deltas else []
+
+        old = get_contributions(self.orders.rows(order_ids), self.items.rows(order_ids),
+                                self.reviews.rows(order_ids))
+
+        self.orders.append(orders)
+        self.items.append(order_items)
+        self.reviews.append(order_reviews)
+        if products is not None:
+            self.product_ids.append(products["product_id"])
+
+        new = get_contributions(self.orders.rows(order_ids), self.items.rows(order_ids),
+                                self.reviews.rows(order_ids))
+
+        self.seller_partials = update_partials(self.seller_partials, new[0], old[0], SELLER_SUMS,
+                                               ["first_order"], ["last_order"])
+        self.product_partials = update_partials(self.product_partials, new[1], old[1], PRODUCT_SUMS)
+
+        if self.verify:
+            for (key, df) in [("orders_df", orders), ("order_items_df", order_items),
+                              ("order_reviews_df", order_reviews), ("products_df", products),
+                              ("sellers_df", sellers)]:
+                if df is not None:
+                    self.history[key].append(df)
+            self.check()
+
+    def check(self, data = None):
+        """
+        Recomputes the aggregates from scratch with Seller and Product, on data or (by
+        default) on everything appended so far, and raises an AssertionError if they
+        differ from the incremental ones.
+        """
+        if data is None:
+            data = {key: pd.concat(dfs, ignore_index = True) for (key, dfs) in self.history.items()}
+
+        super().check(data)
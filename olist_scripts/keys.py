@@ -0,0 +1,125 @@
+"""
+This script dictionary-encodes the ids of my Olist project. Every id space (order_id,
+customer_id, seller_id and product_id) gets a sorted dictionary of its distinct 32-char
+hex ids, and the ids are replaced by their dense int32 position in it. The feature
+builders join and group on those codes, which is much faster than on strings, and
+decode the ids back to strings only in their output.
+
+Since the dictionaries are sorted, ordering by code is the same as ordering by id, so
+groupbys give their rows in the same order too. Missing ids are encoded as -1, which
+only matters for tables with missing ids, which the Olist ones do not have.
+"""
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from olist_scripts.data import get_derived
+
+# the tables whose ids make up every id space: the ones the builders join on it. Other tables
+# (e.g. order_reviews_df) only look ids up in it, their ids that are not in it being encoded as -1
+ID_SPACES = {"order_id": ["orders_df", "order_items_df"],
+             "customer_id": ["customers_df", "orders_df"],
+             "seller_id": ["sellers_df", "order_items_df"],
+             "product_id": ["products_df", "order_items_df"]}
+
+STRING = "string[pyarrow]"
+
+
+def to_arrow(values) -> pa.ChunkedArray:
+    """
+    Returns a series (or array) of ids as an Arrow string array
+    """
+    array = pa.array(values.array if isinstance(values, pd.Series) else values, type = pa.string(),
+                     from_pandas = True)
+
+    return array if isinstance(array, pa.ChunkedArray) else pa.chunked_array([array])
+
+
+def build_dictionary(data, space) -> pa.Array:
+    """
+    Returns the sorted distinct ids of space, out of every table of data it appears in
+    """
+    chunks = [chunk for key_name in ID_SPACES[space] if key_name in data and space in data[key_name]
+              for chunk in to_arrow(data[key_name][space]).chunks]
+    ids = pc.unique(pa.chunked_array(chunks, type = pa.string())).drop_null()
+
+    return ids.take(pc.sort_indices(ids))
+
+
+def get_dictionary(data, space) -> pa.Array:
+    """
+    Returns the dictionary of space for data, built once and then shared
+    """
+    return get_derived(data, f"{space}_dictionary", lambda data: build_dictionary(data, space))
+
+
+def encode(data, space, values) -> np.ndarray:
+    """
+    Returns the int32 codes of the ids in values, -1 for missing ids
+    """
+    codes = pc.index_in(to_arrow(values), value_set = get_dictionary(data, space))
+
+    return pc.fill_null(codes, -1).to_numpy().astype(np.int32)
+
+
+def decode(data, space, codes) -> pd.arrays.ArrowStringArray:
+    """
+    Returns the ids of codes (int or float, as left by a merge), with missing ids
+    where codes are negative or NaN
+    """
+    codes = np.asarray(codes)
+    missing = np.isnan(codes) if codes.dtype.kind == "f" else codes < 0
+    indices = pa.array(np.where(missing, 0, codes).astype(np.int64), mask = missing)
+
+    return pd.array(get_dictionary(data, space).take(indices), dtype = STRING)
+
+
+def encode_frame(data, df, ids = None) -> pd.DataFrame:
+    """
+    Returns a copy of df with its id columns (or only those in ids) replaced by their codes
+    """
+    df = df.copy()
+
+    for space in ID_SPACES:
+        if space in df and (ids is None or space in ids):
+            df[space] = encode(data, space, df[space])
+
+    return df
+
+
+def decode_frame(data, df) -> pd.DataFrame:
+    """
+    Returns a copy of df with every id column (as encoded by encode_frame) back as strings
+    """
+    decoded = {space: decode(data, space, df[space].to_numpy()) for space in ID_SPACES if space in df}
+
+    return df.assign(**decoded)
+
+
+def get_encoded(data, name, builder = None, columns = None, ids = None) -> pd.DataFrame:
+    """
+    Returns the table name of data (or the one builder(data) returns, e.g. a derived
+    table) with its id columns encoded, built once and then shared. It should be copied
+    before being modified.
+
+    If columns is given, only those columns are kept, and if ids is given, only those
+    id columns are encoded, so that only the dictionaries (and the tables they are built
+    from) of the ids the caller uses are needed.
+    """
+    builder = builder or (lambda data: data[name])
+    columns = None if columns is None else list(columns)
+    ids = None if ids is None else list(ids)
+
+    def build(data):
+        df = builder(data)
+        return encode_frame(data, df if columns is None else df[columns], ids)
+
+    # every selection of columns and ids is a derived table of its own, e.g. "orders_df_encoded[order_id]"
+    derived_name = f"{name}_encoded"
+    if columns is not None:
+        derived_name += f"[{','.join(columns)}]"
+    if ids is not None:
+        derived_name += f"({','.join(ids)})"
+
+    return get_derived(data, derived_name, build)
@@ -6,58 +6,48 @@ project.
 import pandas as pd
 import numpy as np
 from olist_scripts.data import Olist
-import datetime
-from haversine import haversine_vector
-
+from olist_scripts.timeline import get_order_timeline
+from olist_scripts.geo import get_geo_index
+from olist_scripts.order_items import get_order_item_stats
+from olist_scripts.profiling import instrumented
+from olist_scripts.feature_cache import cached
+from olist_scripts.parallel import requires, run_builders
+
+@instrumented
+@cached
 class Order:
     """
     Dataframes that have order_id as index and various properties of the orders as columns.
     So far contains methods that create dataframes with useful timedeltas and review related columns.
     """
 
-    def __init__(self):
-        self.data = Olist().retrieve_data()
+    def __init__(self, data = None):
+        # the data is shared with the other olist objects, it is only loaded if not given
+        self.data = Olist().retrieve_data() if data is None else data
 
+    @requires("orders_df")
     def get_timedeltas(self, is_delivered = True):
         """
         Filters only delivered orders, unless otherwise stated by parameter
         is_delivered.
-        Converts string-type, date-containing columns into datetime objects.
-        Then, calculates various timedeltas as decimal numbers. Specifically,
-        calculates total wait time (wait_time), predicted wait time for the
-        order to be delivered (expected_wait_time) and how much time the
-        prediction was off (delay_vs_expected, 0 if it got there early!)
+        Reads various timedeltas as decimal numbers from the shared order timeline
+        (see olist_scripts.timeline). Specifically, total wait time (wait_time),
+        predicted wait time for the order to be delivered (expected_wait_time) and
+        how much time the prediction was off (delay_vs_expected, 0 if it got there early!)
         """
-        orders = self.data["orders_df"].copy()
+        orders = get_order_timeline(self.data)
 
         if is_delivered:
             orders = orders[orders["order_status"] == "delivered"]
 
-        # converting dates to datetime objects
-        temp_list = ["order_purchase_timestamp", "order_approved_at", "order_delivered_carrier_date",
-             "order_delivered_customer_date", "order_estimated_delivery_date"]
-
-        for obj in temp_list:
-            orders[obj] = pd.to_datetime(orders[obj])
-
-        # creating one day datetime object to convert timedeltas into decimal numbers by dividing by it
-        one_day_delta = datetime.timedelta(days=1)
-
-        # calculating new series
-        orders.loc[:,"wait_time"] = (orders["order_delivered_customer_date"] - \
-            orders["order_purchase_timestamp"])/one_day_delta
-
-        orders.loc[:,"expected_wait_time"] = (orders["order_estimated_delivery_date"] - \
-                                            orders["order_purchase_timestamp"])/one_day_delta
-
-        orders.loc[:,"delay_vs_expected"] = (orders["order_delivered_customer_date"] - \
-                                            orders["order_estimated_delivery_date"])/one_day_delta
+        orders = orders[["order_id", "wait_time", "expected_wait_time", "delay_vs_expected", "order_status"]].copy()
 
         # turning negative delays into 0
-        orders["delay_vs_expected"] = orders["delay_vs_expected"].apply(lambda x: 0 if x < 0 else x)
+        orders["delay_vs_expected"] = orders["delay_vs_expected"].clip(lower = 0)
 
-        return orders[["order_id", "wait_time", "expected_wait_time", "delay_vs_expected", "order_status"]]
+        return orders
 
+    @requires("order_reviews_df")
     def get_reviews(self):
         """
         Returns dataframe that contains a per order_id review related row. The dataframe has a 0 or 1 mask
@@ -81,95 +71,93 @@ class Order:
 
         return reviews[["order_id", "dim_is_five_star", "dim_is_one_star", "review_score", "review_all"]]
 
+    @requires("order_items_df")
     def get_num_of_items(self):
         """
         Returns a dataframe that contains a per order id total number of items included.
         """
-        items = self.data["order_items_df"].copy()
+        stats = get_order_item_stats(self.data)
 
-        # summing to find the total items per order
-        return items.groupby(by = "order_id").agg({"order_item_id":"sum"}) \
-            .reset_index().rename(columns = {"order_item_id": "number_of_items"})
+        return stats[["number_of_items"]].reset_index()
 
 
+    @requires("order_items_df")
     def get_num_sellers(self):
         """
         Returns a dataframe that contains a per order id total number of sellers included
         """
-        items = self.data["order_items_df"].copy()
-
-        # counting unique sellers per order id
-        num_of_sellers = items.groupby(by = ["order_id"]).agg({"seller_id": pd.Series.nunique})
+        stats = get_order_item_stats(self.data)
 
-        return num_of_sellers.reset_index().rename( \
-            columns = {"seller_id":"number_of_sellers"})
+        return stats[["number_of_sellers"]].reset_index()
 
+    @requires("order_items_df")
     def get_revenue_and_freight(self):
         """
         Returns the total revenue and freight value related to each order_id
         """
-        items = self.data["order_items_df"].copy()
+        stats = get_order_item_stats(self.data)
 
-        # summing total revenue for the seller and freight cost
-        rev_freight = items.groupby("order_id").agg({"price":"sum", "freight_value": "sum"})
-        return rev_freight.reset_index().rename(columns = {"price": "revenue"})
+        return stats[["revenue", "freight_value"]].reset_index()
 
-    def get_distance_seller_customer(self):
+    @requires("order_items_df")
+    def get_order_item_stats(self):
         """
-        Returns a dataframe with order_id and the (mean) distance (in km) from the
-        seller(s) to the customer.
+        Returns a df indexed by order_id, with the number_of_items, number_of_sellers,
+        revenue and freight_value of every order (see olist_scripts.order_items)
         """
-        # picking columns to create new df
-        orders = self.data["orders_df"][["order_id", "customer_id"]]
-        order_items = self.data["order_items_df"][["order_id", "seller_id"]]
-        sellers = self.data["sellers_df"][["seller_id", "seller_zip_code_prefix"]]
-        customers = self.data["customers_df"][["customer_id", "customer_zip_code_prefix"]]
-        geolocation = self.data["geolocation_df"][["geolocation_zip_code_prefix", "geolocation_lat", "geolocation_lng"]]
-
-        distance_df = orders.merge(order_items, on="order_id", how="left") \
-                            .merge(sellers, on="seller_id", how="left") \
-                            .merge(customers, on="customer_id", how="left")
+        return get_order_item_stats(self.data)
 
-        # averaging lat and long for each zip code and merging with main df
-        sellers_geo = geolocation.rename(columns={'geolocation_lat': 'seller_lat', \
-            'geolocation_lng': 'seller_lng'}).groupby(by = "geolocation_zip_code_prefix").mean()
-        customers_geo = geolocation.rename(columns={'geolocation_lat': 'customer_lat', \
-            'geolocation_lng': 'customer_lng'}).groupby(by = "geolocation_zip_code_prefix").mean()
-
-        distance_df = distance_df.merge(sellers_geo, left_on="seller_zip_code_prefix", \
-            right_on="geolocation_zip_code_prefix", how="inner").merge(customers_geo, \
-                left_on="customer_zip_code_prefix", right_on="geolocation_zip_code_prefix", how="left")
+    @requires("orders_df", "order_items_df", "geolocation_df", "sellers_df", "customers_df")
+    def get_distance_seller_customer(self, impute = True):
+        """
+        Returns a dataframe with order_id and the (mean) distance (in km) from the
+        seller(s) to the customer. Zip prefixes missing from the geolocation data get the
+        coordinates of a neighbouring prefix, or of their city or state (see
+        olist_scripts.geo), unless impute is False. Orders whose seller or customer still
+        has no coordinates are left out.
+        """
+        geo = get_geo_index(self.data)
+        orders = self.data["orders_df"]
+        items = self.data["order_items_df"]
 
-        distance_df = distance_df.dropna(subset=["seller_lat", "seller_lng", "customer_lat", "customer_lng"])
+        # finding the customer of every item's order
+        order_positions = pd.Index(orders["order_id"]).get_indexer(items["order_id"])
+        customer_ids = orders["customer_id"].to_numpy()[order_positions]
+        customer_ids[order_positions < 0] = None
 
-        # turning to numpy form to feed into haversine function
-        seller_coords = distance_df[["seller_lat", "seller_lng"]].to_numpy()
-        customer_coords = distance_df[["customer_lat", "customer_lng"]].to_numpy()
+        distance_km = geo.distance(items["seller_id"], customer_ids, impute)
+        known = np.isfinite(distance_km)
 
-        distance_df['distance_km'] = haversine_vector(seller_coords, customer_coords, unit='km')
+        distance_df = pd.DataFrame({"order_id": items["order_id"].array[known],
+                                    "distance_km": distance_km[known]})
 
         return distance_df.groupby(by = "order_id", as_index=False)["distance_km"].mean()
 
 
     def get_training_data(self,
                           is_delivered=True,
-                          with_distance_seller_customer=False):
+                          with_distance_seller_customer=False,
+                          executor="serial"):
         """
         Returns a dataframe with no null values, that contain all the columns above, namely:
         ['order_id', 'wait_time', 'expected_wait_time', 'delay_vs_expected',
         'order_status', 'dim_is_five_star', 'dim_is_one_star', 'review_score', 'review_all',
         'number_of_items', 'number_of_sellers', 'revenue', 'freight_value',
         'distance_seller_customer']
+
+        The features are built by executor, "serial", "thread" or "process" (see
+        olist_scripts.parallel), with the same results.
         """
+        calls = [("get_timedeltas", {"is_delivered": is_delivered}), "get_reviews", "get_order_item_stats"]
+        if with_distance_seller_customer:
+            calls.append("get_distance_seller_customer")
+
+        timedeltas, reviews, stats, *distance = run_builders(self, calls, executor)
+
+        # the item related features are aggregated together, and joined by their order_id index
+        training_data = timedeltas.merge(reviews, on = "order_id").join(stats, on = "order_id", how = "inner")
 
         if with_distance_seller_customer:
-            return self.get_timedeltas(is_delivered).merge(self.get_reviews(), on = "order_id") \
-            .merge(self.get_num_of_items(), on = "order_id") \
-            .merge(self.get_num_sellers(), on = "order_id") \
-            .merge(self.get_revenue_and_freight(), on = "order_id") \
-            .merge(self.get_distance_seller_customer()).dropna()
-
-        return self.get_timedeltas(is_delivered).merge(self.get_reviews(), on = "order_id") \
-            .merge(self.get_num_of_items(), on = "order_id") \
-            .merge(self.get_num_sellers(), on = "order_id") \
-            .merge(self.get_revenue_and_freight(), on = "order_id").dropna()
+            return training_data.merge(distance[0]).dropna()
+
+        return training_data.dropna()
@@ -0,0 +1,60 @@
+"""
+This script aggregates the order items per order for my Olist project. The item count,
+the number of distinct sellers, the revenue and the freight value of every order are
+computed together, in a single pass over order_items, and shared by the Order methods.
+"""
+
+import numpy as np
+import pandas as pd
+from olist_scripts.data import get_derived
+
+
+def segment_sum(codes, values, n_segments) -> np.ndarray:
+    """
+    Returns the sum of values per segment, where codes holds the segment (0 to n_segments - 1)
+    of every value. Missing values add nothing, like in a groupby sum.
+    """
+    weights = np.nan_to_num(np.asarray(values, dtype = np.float64))
+
+    return np.bincount(codes, weights = weights, minlength = n_segments)
+
+
+def build_order_item_stats(data) -> pd.DataFrame:
+    """
+    Returns a df indexed by order_id (sorted), with the number_of_items (the sum of the
+    order_item_id column, as Order has always computed it), number_of_sellers, revenue
+    and freight_value of every order that has items.
+    """
+    items = data["order_items_df"]
+
+    # turning the order and seller ids into integer codes, to reduce over them with bincount
+    order_codes, order_ids = pd.factorize(items["order_id"], sort = True)
+    seller_codes, seller_ids = pd.factorize(items["seller_id"])
+    n_orders, n_sellers = len(order_ids), max(len(seller_ids), 1)
+
+    # items without an order are left out, and missing values add nothing, like in a groupby sum
+    has_order = order_codes >= 0
+    order_codes, seller_codes = order_codes[has_order], seller_codes[has_order]
+
+    number_of_items = segment_sum(order_codes, items["order_item_id"].to_numpy()[has_order], n_orders)
+    revenue = segment_sum(order_codes, items["price"].to_numpy()[has_order], n_orders)
+    freight_value = segment_sum(order_codes, items["freight_value"].to_numpy()[has_order], n_orders)
+
+    # counting each distinct (order, seller) pair once, items without a seller are not counted
+    has_seller = seller_codes >= 0
+    pairs = np.unique(order_codes[has_seller].astype(np.int64)*n_sellers + seller_codes[has_seller])
+    number_of_sellers = np.bincount(pairs//n_sellers, minlength = n_orders)
+
+    return pd.DataFrame({"number_of_items": number_of_items.astype(np.int64),
+                         "number_of_sellers": number_of_sellers.astype(np.int64),
+                         "revenue": revenue,
+                         "freight_value": freight_value},
+                        index = pd.Index(order_ids, name = "order_id"))
+
+
+def get_order_item_stats(data) -> pd.DataFrame:
+    """
+    Returns the per order item aggregates of data (see build_order_item_stats), built
+    once and then shared. It should be copied before being modified.
+    """
+    return get_derived(data, "order_item_stats", build_order_item_stats)
@@ -0,0 +1,122 @@
+"""
+This script runs independent feature builders (the get_* methods of Order, Product,
+Seller and Review) concurrently for my Olist project, either serially, in a thread
+pool or in a process pool.
+
+Builders declare the tables they read with the requires decorator. The process pool
+only ships those tables to the workers, through shared memory: each table is written
+once as an Arrow IPC buffer, which the workers map without copying.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+import pyarrow as pa
+
+EXECUTORS = ["serial", "thread", "process"]
+
+# tables already mapped by a worker process, shared memory name -> (handle, df)
+_worker_tables = {}
+
+
+def requires(*key_names):
+    """
+    Decorator that declares the tables (e.g. "orders_df") a builder method reads,
+    directly or through the methods and derived tables it uses
+    """
+    def decorator(method):
+        method.tables = key_names
+        return method
+
+    return decorator
+
+
+def get_required_tables(cls, method, data) -> list:
+    """
+    Returns the tables the builder cls.method needs, or every table if it declares none
+    """
+    tables = getattr(getattr(cls, method), "tables", None)
+
+    return list(data.keys()) if tables is None else list(tables)
+
+
+def share_table(df) -> shared_memory.SharedMemory:
+    """
+    Writes df to a new block of shared memory as an Arrow IPC stream, and returns the block
+    """
+    table = pa.Table.from_pandas(df, preserve_index = False)
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    buffer = sink.getvalue()
+
+    block = shared_memory.SharedMemory(create = True, size = max(buffer.size, 1))
+    block.buf[:buffer.size] = memoryview(buffer).cast("B")
+
+    return block
+
+
+def _read_shared_table(name):
+    """
+    Returns the df in the shared memory block name, mapping it only once per worker process
+    """
+    # importing here, since only the workers need it
+    from olist_scripts.snapshot import STRING_TYPES
+
+    if name not in _worker_tables:
+        # the parent process owns the block and unlinks it, the worker only reads it
+        block = shared_memory.SharedMemory(name = name)
+        table = pa.ipc.open_stream(pa.py_buffer(block.buf)).read_all()
+        _worker_tables[name] = (block, table.to_pandas(types_mapper = STRING_TYPES.get))
+
+    return _worker_tables[name][1]
+
+
+def _run_in_worker(cls, method, kwargs, shared_names):
+    """
+    Runs cls(data).method(**kwargs) in a worker process, where data only holds the
+    tables in shared_names (a dictionary of table name -> shared memory name)
+    """
+    data = {key_name: _read_shared_table(name) for (key_name, name) in shared_names.items()}
+
+    return getattr(cls(data), method)(**kwargs)
+
+
+def run_builders(instance, calls, executor = "serial", max_workers = None) -> list:
+    """
+    Runs the builder methods of instance (an Order, Product, Seller or Review) and
+    returns their results in the same order. calls is a list of method names or of
+    (method name, kwargs) tuples. executor is one of "serial", "thread" or "process".
+    The results are the same whichever executor runs them.
+    """
+    if executor not in EXECUTORS:
+        raise ValueError(f"executor should be one of {EXECUTORS}, not {executor!r}")
+
+    calls = [(call, {}) if isinstance(call, str) else call for call in calls]
+
+    if executor == "serial":
+        return [getattr(instance, method)(**kwargs) for (method, kwargs) in calls]
+
+    if executor == "thread":
+        with ThreadPoolExecutor(max_workers = max_workers or len(calls)) as pool:
+            futures = [pool.submit(getattr(instance, method), **kwargs) for (method, kwargs) in calls]
+            return [future.result() for future in futures]
+
+    # sharing every needed table once, and only passing each builder the ones it requires
+    cls, data = type(instance), instance.data
+    required = [get_required_tables(cls, method, data) for (method, _) in calls]
+    blocks = {}
+
+    try:
+        for key_name in dict.fromkeys(sum(required, [])):
+            blocks[key_name] = share_table(data[key_name])
+
+        with ProcessPoolExecutor(max_workers = max_workers or len(calls)) as pool:
+            futures = [pool.submit(_run_in_worker, cls, method, kwargs,
+                                   {key_name: blocks[key_name].name for key_name in tables})
+                       for ((method, kwargs), tables) in zip(calls, required)]
+            return [future.result() for future in futures]
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
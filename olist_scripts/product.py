@@ -7,16 +7,27 @@ import pandas as pd
 import numpy as np
 from olist_scripts.data import Olist
 from olist_scripts.order import Order
-
+from olist_scripts.timeline import get_order_timeline
+from olist_scripts.streaming import get_streaming_aggregates
+from olist_scripts.sql import get_sqlite
+from olist_scripts.keys import decode_frame, get_encoded
+from olist_scripts.facts import get_first_pairs, get_order_item_facts, get_order_review_stats
+from olist_scripts.profiling import instrumented
+from olist_scripts.feature_cache import cached
+from olist_scripts.parallel import requires, run_builders
+
+@instrumented
+@cached
 class Product:
     """
     Dataframes that have product_id as their index and a variety of features
     related to products, some engineered and some already existing.
     """
-    def __init__(self):
-        self.data = Olist().retrieve_data()
-        self.order = Order()
+    def __init__(self, data = None):
+        self.data = Olist().retrieve_data() if data is None else data
+        self.order = Order(self.data)
 
+    @requires("products_df", "product_category_name_translation_df")
     def get_listing_features(self):
         """
         Returns a df with the basic listing features of a product, like category,
@@ -42,14 +53,26 @@ class Product:
 
         return temp
 
-    def get_sales_features(self):
+    @requires("products_df", "order_items_df")
+    def get_sales_features(self, chunk_size = None, backend = "pandas"):
         """
         Returns a df with features related to its sales, like average price, how many
         of it were sold, number of orders that included it and total revenue because of
         it.
+
+        If chunk_size is given, it is computed out of core from the csv files, reading at most
+        chunk_size rows at a time (see olist_scripts.streaming). With backend = "sqlite", it
+        is aggregated by sqlite from the sqlite file instead (see olist_scripts.sql).
         """
-        products = self.data["products_df"]
-        items = self.data["order_items_df"]
+        if backend == "sqlite":
+            return get_sqlite(self.data).get_sales_features()
+        if chunk_size is not None:
+            return get_streaming_aggregates(self.data, chunk_size).get_sales_features()
+        # joining and grouping on the integer codes of the ids (see olist_scripts.keys)
+        # the orders are only counted, so their ids are left as they are
+        products = get_encoded(self.data, "products_df", columns = ["product_id"])
+        items = get_encoded(self.data, "order_items_df", columns = ["order_id", "order_item_id", "product_id", "price"],
+                            ids = ["product_id"])
 
         temp = products.merge(items, how = "left", on = "product_id")
 
@@ -60,52 +83,71 @@ class Product:
 
         temp["total_revenue"] = temp["n_orders"]*temp["mean_price"]
 
-        return temp
+        return decode_frame(self.data, temp)
 
+    @requires("orders_df", "order_items_df", "order_reviews_df", "products_df", "sellers_df")
     def get_product_review_features(self):
         """
         Returns a df with features related to the reviews for the product.
         Includes mean review score, share of one star and five star reviews.
         """
 
-        order_reviews = self.order.get_reviews()
-        products = self.data["products_df"]
-        items = self.data["order_items_df"]
+        # every distinct order and product of the order item facts, with the first review of the order
+        # (see olist_scripts.facts)
+        facts = get_order_item_facts(self.data)
+        pairs = facts.iloc[get_first_pairs(facts["order_id"], facts["product_id"])]
+        pairs = pairs[(pairs["order_id"] >= 0) & (pairs["product_id"] >= 0)]
 
-        temp = order_reviews.merge(items, how = "left", on = "order_id") \
-            .merge(products, how = "left", on = "product_id").drop_duplicates(subset = ["order_id", "product_id"])
+        reviews = get_order_review_stats(self.data).iloc[pairs["order_id"].to_numpy()]
+        reviewed = reviews["n_reviews"].to_numpy() > 0
+        scores = reviews["first_score"].to_numpy()[reviewed]
 
-        temp = temp.groupby(by = "product_id", as_index = False).agg({"dim_is_five_star": "sum", "dim_is_one_star": "sum",
-                                             "review_score": "mean", "order_id": "nunique"})
+        temp = pd.DataFrame({"product_id": pairs["product_id"].to_numpy()[reviewed],
+                             "dim_is_five_star": (scores == 5).astype(np.int64),
+                             "dim_is_one_star": (scores == 1).astype(np.int64),
+                             "review_score": scores})
 
-        temp["share_of_one_stars"] = temp["dim_is_one_star"]/temp["order_id"]
-        temp["share_of_five_stars"] = temp["dim_is_five_star"]/temp["order_id"]
+        # the pairs are distinct, so every row is a different order of the product
+        temp = temp.groupby(by = "product_id", as_index = False).agg(dim_is_five_star = ("dim_is_five_star", "sum"),
+            dim_is_one_star = ("dim_is_one_star", "sum"), review_score = ("review_score", "mean"),
+            order_count = ("product_id", "size"))
 
-        return temp[["product_id", "share_of_five_stars", "share_of_one_stars", "review_score"]]
+        temp["share_of_one_stars"] = temp["dim_is_one_star"]/temp["order_count"]
+        temp["share_of_five_stars"] = temp["dim_is_five_star"]/temp["order_count"]
 
+        return decode_frame(self.data, temp[["product_id", "share_of_five_stars", "share_of_one_stars", "review_score"]])
+
+    @requires("orders_df", "order_items_df", "products_df", "sellers_df")
     def get_wait_time(self):
         """
         Returns a df with the average wait time per product
         """
-        order_times = self.order.get_timedeltas()
-        products = self.data["products_df"]
-        items = self.data["order_items_df"]
+        order_times = get_encoded(self.data, "order_timeline", get_order_timeline,
+                                  columns = ["order_id", "order_status", "wait_time"])
+        order_times = order_times[order_times["order_status"] == "delivered"]
 
-        temp = order_times.merge(items, how = "left", on = "order_id") \
-            .merge(products, how = "left", on = "product_id").drop_duplicates(subset = ["order_id", "product_id"])
+        # every distinct order and product of the order item facts (see olist_scripts.facts)
+        facts = get_order_item_facts(self.data)
+        items = facts.iloc[get_first_pairs(facts["order_id"], facts["product_id"])][["order_id", "product_id"]]
+
+        temp = order_times.merge(items, how = "left", on = "order_id")
 
         temp = temp.groupby(by = "product_id", as_index = False).agg({"wait_time": "mean"})
 
-        return temp
+        return decode_frame(self.data, temp)
 
-    def get_training_data(self):
+    def get_training_data(self, executor = "serial"):
         """
         Returns a dataframe with all the per product features above combined.
+        The features are built by executor, "serial", "thread" or "process" (see
+        olist_scripts.parallel), with the same results.
         """
+        listing, review, sales, wait_time = run_builders(self, ["get_listing_features", "get_product_review_features",
+                                                                "get_sales_features", "get_wait_time"], executor)
 
-        return self.get_listing_features().merge(self.get_product_review_features(), on = "product_id", how = "left") \
-            .merge(self.get_sales_features(), on = "product_id", how = "left") \
-            .merge(self.get_wait_time(), on  = "product_id", how = "left")
+        return listing.merge(review, on = "product_id", how = "left") \
+            .merge(sales, on = "product_id", how = "left") \
+            .merge(wait_time, on  = "product_id", how = "left")
 
     def get_data_per_category(self):
         """
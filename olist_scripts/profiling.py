@@ -0,0 +1,309 @@
+"""
+This script profiles the feature builders of my Olist project. While profiling is on,
+every get_* call of Order, Product, Seller and Review, every table load and every
+derived table build is recorded with its wall time, rows in and out, peak memory
+delta and the calls it was made from, e.g.
+
+    with profile() as profiler:
+        Seller().get_training_data()
+    profiler.write("trace.json")
+
+The trace opens in chrome://tracing or https://ui.perfetto.dev. Setting the
+OLIST_PROFILE environment variable to a path profiles the whole process instead,
+and writes the trace there when it exits. When profiling is off, an instrumented
+call costs one extra function call.
+"""
+
+import atexit
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+import pandas as pd
+
+ENV_VAR = "OLIST_PROFILE"
+FORMAT_ENV_VAR = "OLIST_PROFILE_FORMAT"
+FORMATS = ["chrome", "json"]
+
+# the profiler recording the calls, None when profiling is off
+_profiler = None
+
+
+class Span:
+    """
+    One recorded call, with the spans of the calls made during it as children
+    """
+
+    def __init__(self, name, parent, rows_in = None):
+        self.name = name
+        self.parent = parent
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.children = []
+        self.thread_id = threading.get_ident()
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.memory_start = None
+        self.peak = 0
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "seconds": self.seconds, "rows_in": self.rows_in, "rows_out": self.rows_out,
+                "peak_memory_mb": self.get_peak_memory_mb(), "thread_id": self.thread_id,
+                "children": [child.to_dict() for child in self.children]}
+
+    def get_peak_memory_mb(self):
+        """
+        Returns by how much (in MB) the traced memory peaked above its level at the start
+        of the call, or None if memory was not traced
+        """
+        if self.memory_start is None:
+            return None
+
+        return max(self.peak - self.memory_start, 0)/1e6
+
+
+class Profiler:
+    """
+    Records spans (see Span) as a tree per thread. With trace_memory, the peak memory
+    of every span is traced with tracemalloc, which slows the profiled code down
+    noticeably, and mixes the allocations of concurrent threads.
+    """
+
+    def __init__(self, trace_memory = True):
+        self.trace_memory = trace_memory
+        self.origin = time.perf_counter()
+        self.roots = []
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._started_tracemalloc = False
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def stop(self):
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _get_stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+
+        return self._local.stack
+
+    def enter(self, name, rows_in = None) -> Span:
+        stack = self._get_stack()
+        parent = stack[-1] if stack else None
+        span = Span(name, parent, rows_in)
+
+        if self.trace_memory and tracemalloc.is_tracing():
+            # the peak is global, so the parent keeps the one reached so far before it is reset
+            current, peak = tracemalloc.get_traced_memory()
+            if parent is not None:
+                parent.peak = max(parent.peak, peak)
+            tracemalloc.reset_peak()
+            span.memory_start = current
+
+        if parent is None:
+            with self._lock:
+                self.roots.append(span)
+        else:
+            parent.children.append(span)
+
+        stack.append(span)
+
+        return span
+
+    def exit(self, span, rows_out = None):
+        span.seconds = time.perf_counter() - span.start
+        span.rows_out = rows_out
+
+        if span.memory_start is not None and tracemalloc.is_tracing():
+            span.peak = max(span.peak, tracemalloc.get_traced_memory()[1])
+            if span.parent is not None:
+                span.parent.peak = max(span.parent.peak, span.peak)
+
+        stack = self._get_stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+
+    def get_spans(self) -> list:
+        """
+        Returns every recorded span, parents before their children
+        """
+        spans, pending = [], list(reversed(self.roots))
+        while pending:
+            span = pending.pop()
+            spans.append(span)
+            pending.extend(reversed(span.children))
+
+        return spans
+
+    def get_report(self) -> pd.DataFrame:
+        """
+        Returns a df with one row per recorded span, with its depth in the call tree,
+        wall time, rows in and out and peak memory delta
+        """
+        rows = []
+        for span in self.get_spans():
+            depth, parent = 0, span.parent
+            while parent is not None:
+                depth, parent = depth + 1, parent.parent
+
+            rows.append({"name": span.name, "depth": depth, "seconds": span.seconds,
+                         "rows_in": span.rows_in, "rows_out": span.rows_out,
+                         "peak_memory_mb": span.get_peak_memory_mb(), "thread_id": span.thread_id})
+
+        return pd.DataFrame(rows, columns = ["name", "depth", "seconds", "rows_in", "rows_out",
+                                             "peak_memory_mb", "thread_id"])
+
+    def to_json(self) -> dict:
+        """
+        Returns the call trees, as nested dictionaries
+        """
+        return {"spans": [span.to_dict() for span in self.roots]}
+
+    def to_chrome_trace(self) -> dict:
+        """
+        Returns the spans in the Chrome trace event format, as complete ("X") events
+        """
+        events = []
+        for span in self.get_spans():
+            if span.seconds is None:
+                continue
+
+            events.append({"name": span.name, "ph": "X", "pid": os.getpid(), "tid": span.thread_id,
+                           "ts": (span.start - self.origin)*1e6, "dur": span.seconds*1e6,
+                           "args": {"rows_in": span.rows_in, "rows_out": span.rows_out,
+                                    "peak_memory_mb": span.get_peak_memory_mb()}})
+
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path, format = "chrome"):
+        """
+        Writes the trace to path, either in the Chrome trace format or as nested json
+        """
+        if format not in FORMATS:
+            raise ValueError(f"format should be one of {FORMATS}, not {format!r}")
+
+        trace = self.to_chrome_trace() if format == "chrome" else self.to_json()
+
+        with open(path, "w") as file:
+            json.dump(trace, file, indent = 1)
+
+
+@contextlib.contextmanager
+def profile(trace_memory = True):
+    """
+    Context manager that profiles the calls made inside it, and yields the Profiler
+    """
+    global _profiler
+
+    previous = _profiler
+    profiler = Profiler(trace_memory)
+    profiler.start()
+    _profiler = profiler
+
+    try:
+        yield profiler
+    finally:
+        _profiler = previous
+        profiler.stop()
+
+
+@contextlib.contextmanager
+def span(name, rows_in = None):
+    """
+    Context manager that records the code inside it as a span named name, if profiling
+    is on. It yields a dictionary in which "rows_out" can be set.
+    """
+    profiler = _profiler
+    if profiler is None:
+        yield {}
+        return
+
+    current = profiler.enter(name, rows_in)
+    result = {}
+    try:
+        yield result
+    finally:
+        profiler.exit(current, result.get("rows_out"))
+
+
+def count_rows(value):
+    """
+    Returns the number of rows of a df (or anything with a length), otherwise None
+    """
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+def get_rows_in(data, tables) -> int:
+    """
+    Returns the total number of rows of the given tables of data, only counting the
+    ones already loaded, so that nothing is loaded just to be counted
+    """
+    loaded = [key_name for key_name in tables
+              if key_name in data and (not hasattr(data, "is_loaded") or data.is_loaded(key_name))]
+
+    return int(sum(len(data[key_name]) for key_name in loaded))
+
+
+def _wrap(cls_name, method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profiler = _profiler
+        if profiler is None:
+            return method(self, *args, **kwargs)
+
+        # the rows in are those of the tables the method declares (see olist_scripts.parallel)
+        tables = getattr(method, "tables", None)
+        current = profiler.enter(f"{cls_name}.{method.__name__}")
+        try:
+            result = method(self, *args, **kwargs)
+        except BaseException:
+            profiler.exit(current)
+            raise
+
+        if tables is not None:
+            current.rows_in = get_rows_in(self.data, tables)
+        profiler.exit(current, count_rows(result))
+
+        return result
+
+    return wrapper
+
+
+def instrumented(cls):
+    """
+    Class decorator that makes every get_* method of cls record a span while profiling is on
+    """
+    for (name, method) in list(vars(cls).items()):
+        if name.startswith("get_") and callable(method):
+            setattr(cls, name, _wrap(cls.__name__, method))
+
+    return cls
+
+
+def _profile_process(path, format):
+    """
+    Profiles the whole process, writing the trace to path when it exits
+    """
+    global _profiler
+
+    _profiler = Profiler()
+    _profiler.start()
+
+    atexit.register(_profiler.write, path, format)
+
+
+if os.environ.get(ENV_VAR):
+    _profile_process(os.environ[ENV_VAR], os.environ.get(FORMAT_ENV_VAR, "chrome"))
@@ -0,0 +1,186 @@
+"""
+This script runs the what-if analysis of my Olist project: how much would Olist's profit
+grow by removing its worst sellers, under the billing scheme of the Le Wagon project.
+Olist earns a sales fee on every item sold and a monthly subscription from every seller,
+pays a reputation cost for every bad review, and pays IT costs that grow with the square
+root of the number of sellers and of items sold.
+
+The revenue, reputation cost and items of every seller are computed once. Ranking the
+sellers by a criterion (worst first), the profit after removing the worst k sellers is
+then read off cumulative sums over that ranking, for every k from 0 to the number of
+sellers at once, and for every combination of a grid of fees at once too.
+"""
+
+import numpy as np
+import pandas as pd
+from olist_scripts.data import Olist, get_derived
+from olist_scripts.keys import encode, get_dictionary, get_encoded
+from olist_scripts.seller_time import get_seller_time_index
+
+SALES_FEE = 0.1
+SUBSCRIPTION_FEE = 80
+
+# the cost of a review of every score to Olist's reputation
+REVIEW_COSTS = {1: 100, 2: 50, 3: 40, 4: 0, 5: 0}
+
+# the IT costs of n sellers selling m items are alpha*sqrt(n) + beta*sqrt(m)
+IT_COSTS = {"alpha": 3157.27, "beta": 978.23}
+
+# the criteria sellers can be ranked by, worst first, and whether they are worst when low
+CRITERIA = {"profit": True, "revenue": True, "sales": True, "review_score": True, "review_costs": False}
+
+SCORES = list(REVIEW_COSTS)
+
+
+def build_seller_contributions(data) -> pd.DataFrame:
+    """
+    Returns a df with the seller_id, months_on_olist, n_orders, n_items, sales (the sum
+    of the item prices), review_score and number of reviews of every score of every seller
+    that sold something
+    """
+    df = get_seller_time_index(data).get_window()[["seller_id", "months_on_olist", "order_count", "revenue"]] \
+        .rename(columns = {"order_count": "n_orders", "revenue": "sales"})
+    codes = encode(data, "seller_id", df["seller_id"])
+    n_sellers = len(get_dictionary(data, "seller_id"))
+
+    orders = get_encoded(data, "orders_df", columns = ["order_id"])
+    items = get_encoded(data, "order_items_df", columns = ["order_id", "seller_id"]).merge(orders, on = "order_id")
+    df["n_items"] = np.bincount(items["seller_id"], minlength = n_sellers)[codes]
+
+    # a review counts once for every seller of the order it reviews
+    reviews = get_encoded(data, "order_reviews_df", columns = ["order_id", "review_id", "review_score"])
+    reviews = reviews.merge(items.drop_duplicates(), on = "order_id").drop_duplicates(["seller_id", "order_id",
+                                                                                       "review_id"])
+    reviews = reviews[reviews["review_score"].isin(SCORES)]
+
+    for score in SCORES:
+        scored = reviews["seller_id"][reviews["review_score"] == score]
+        df[f"reviews_{score}"] = np.bincount(scored, minlength = n_sellers)[codes]
+
+    counts = df[[f"reviews_{score}" for score in SCORES]].to_numpy()
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        df["review_score"] = counts @ np.array(SCORES, dtype = float)/counts.sum(axis = 1)
+
+    return df
+
+
+def get_seller_contributions(data) -> pd.DataFrame:
+    """
+    Returns the seller contributions of data, built once and then shared
+    """
+    return get_derived(data, "seller_contributions", build_seller_contributions)
+
+
+def get_it_costs(n_sellers, n_items, it_costs = IT_COSTS) -> np.ndarray:
+    return it_costs["alpha"]*np.sqrt(n_sellers) + it_costs["beta"]*np.sqrt(n_items)
+
+
+def get_fee_grid(sales_fees = SALES_FEE, subscription_fees = SUBSCRIPTION_FEE) -> tuple:
+    """
+    Returns the sales and subscription fees of every combination of sales_fees and
+    subscription_fees (single values or lists), as two flat arrays
+    """
+    sales_fees, subscription_fees = np.meshgrid(np.atleast_1d(sales_fees).astype(float),
+                                                np.atleast_1d(subscription_fees).astype(float), indexing = "ij")
+
+    return sales_fees.ravel(), subscription_fees.ravel()
+
+
+def get_seller_profits(contributions, sales_fees, subscription_fees, review_costs = REVIEW_COSTS) -> tuple:
+    """
+    Returns the revenue, reputation costs and profit (before IT costs) Olist makes out of
+    every seller (columns), for every pair of fees (rows)
+    """
+    revenues = sales_fees[:, None]*contributions["sales"].to_numpy()[None, :] \
+        + subscription_fees[:, None]*contributions["months_on_olist"].to_numpy()[None, :]
+
+    counts = contributions[[f"reviews_{score}" for score in SCORES]].to_numpy()
+    costs = np.broadcast_to(counts @ np.array([review_costs[score] for score in SCORES], dtype = float),
+                            revenues.shape)
+
+    return revenues, costs, revenues - costs
+
+
+def rank_sellers(contributions, criterion, revenues, costs, profits) -> np.ndarray:
+    """
+    Returns the positions of the sellers of contributions, worst first by criterion, for
+    every pair of fees (rows). Ties keep the order of contributions.
+    """
+    if criterion not in CRITERIA:
+        raise ValueError(f"unknown criterion {criterion}, expected one of {list(CRITERIA)}")
+
+    values = {"profit": profits, "revenue": revenues, "review_costs": costs}.get(criterion)
+    if values is None:
+        values = np.broadcast_to(contributions[criterion].to_numpy(dtype = float), profits.shape)
+
+    # sellers without reviews have no review_score, and are never the worst by it
+    values = np.where(np.isnan(values), np.inf, values)
+
+    return np.argsort(values if CRITERIA[criterion] else -values, axis = 1, kind = "stable")
+
+
+def simulate_removals(contributions, criterion = "profit", sales_fees = SALES_FEE,
+                      subscription_fees = SUBSCRIPTION_FEE, review_costs = REVIEW_COSTS,
+                      it_costs = IT_COSTS) -> pd.DataFrame:
+    """
+    Returns a df with Olist's revenues, review_costs, it_costs and profit after removing
+    the worst n_removed sellers by criterion, for every n_removed from 0 to the number of
+    sellers and every combination of sales_fees and subscription_fees (single values or
+    lists)
+    """
+    sales_fees, subscription_fees = get_fee_grid(sales_fees, subscription_fees)
+    revenues, costs, profits = get_seller_profits(contributions, sales_fees, subscription_fees, review_costs)
+    order = rank_sellers(contributions, criterion, revenues, costs, profits)
+
+    # what is left after removing the worst k sellers is the total minus the cumulative sum of the k worst
+    def get_remaining(values):
+        ranked = np.take_along_axis(np.broadcast_to(values, order.shape), order, axis = 1)
+        removed = np.concatenate([np.zeros((len(order), 1)), np.cumsum(ranked, axis = 1)], axis = 1)
+
+        return removed[:, -1:] - removed
+
+    n_sellers = len(contributions)
+    n_removed = np.arange(n_sellers + 1)
+    remaining_items = get_remaining(contributions["n_items"].to_numpy(dtype = float))
+
+    df = pd.DataFrame({"sales_fee": np.repeat(sales_fees, n_sellers + 1),
+                       "subscription_fee": np.repeat(subscription_fees, n_sellers + 1),
+                       "n_removed": np.tile(n_removed, len(sales_fees)),
+                       "revenues": get_remaining(revenues).ravel(),
+                       "review_costs": get_remaining(costs).ravel(),
+                       "it_costs": get_it_costs(n_sellers - n_removed[None, :], remaining_items, it_costs).ravel()})
+
+    df["profit"] = df["revenues"] - df["review_costs"] - df["it_costs"]
+
+    return df
+
+
+def get_optimal_removals(curves) -> pd.DataFrame:
+    """
+    Returns the rows of the profit curves of simulate_removals with the highest profit,
+    one per pair of fees
+    """
+    best = curves.groupby(["sales_fee", "subscription_fee"], sort = False)["profit"].idxmax()
+
+    return curves.loc[best].reset_index(drop = True)
+
+
+def get_removed_sellers(contributions, n_removed, criterion = "profit", sales_fee = SALES_FEE,
+                        subscription_fee = SUBSCRIPTION_FEE, review_costs = REVIEW_COSTS) -> pd.Series:
+    """
+    Returns the seller_ids of the worst n_removed sellers by criterion, worst first
+    """
+    sales_fees, subscription_fees = get_fee_grid(sales_fee, subscription_fee)
+    order = rank_sellers(contributions, criterion,
+                         *get_seller_profits(contributions, sales_fees, subscription_fees, review_costs))
+
+    return contributions["seller_id"].iloc[order[0, :n_removed]].reset_index(drop = True)
+
+
+def get_profit_curves(data = None, criterion = "profit", **kwargs) -> pd.DataFrame:
+    """
+    Returns simulate_removals over the sellers of data (the whole dataset by default)
+    """
+    data = Olist().retrieve_data() if data is None else data
+
+    return simulate_removals(get_seller_contributions(data), criterion, **kwargs)
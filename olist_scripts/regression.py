@@ -0,0 +1,243 @@
+"""
+This script fits the OLS regressions of my Olist project (e.g. review_score ~ wait_time +
+delay_vs_expected + distance_km) for many groups (e.g. every product category or state)
+and many feature subsets at once, instead of one statsmodels fit at a time.
+
+The features are centered and scaled once, and the cross products X'X and X'y of every
+group are summed with one bincount per pair of columns. Every model is then solved out of
+them for all the groups together, with batched (pseudo) inverses, like statsmodels' OLS
+does for a single group, and its coefficients, standard errors, t and p values and R²
+come out in one tidy df.
+
+Features that are aliased within a group (constant in it, or a linear combination of the
+constant and the features before them) are left out of that group's model: their coef is
+0, and their std_err, t and p values are NaN.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from olist_scripts.order import Order
+
+# a feature is aliased in a group when what is left of its sum of squares, once the constant and the
+# features before it are projected out, is below this share of its sum of squares
+ALIAS_TOLERANCE = 1e-10
+
+
+def get_order_regression_data(data) -> pd.DataFrame:
+    """
+    Returns Order.get_training_data (with the distances) with the category of the first
+    item of every order, and the states of its customer and of the seller of that item,
+    to group the regressions by
+    """
+    df = Order(data).get_training_data(with_distance_seller_customer = True)
+
+    items = data["order_items_df"]
+    items = items[items["order_item_id"] == items.groupby("order_id", observed = True)["order_item_id"]
+                  .transform("min")].drop_duplicates("order_id")
+    items = items[["order_id", "product_id", "seller_id"]] \
+        .merge(data["products_df"][["product_id", "product_category_name"]], on = "product_id", how = "left") \
+        .merge(data["sellers_df"][["seller_id", "seller_state"]], on = "seller_id", how = "left")
+
+    customers = data["orders_df"][["order_id", "customer_id"]] \
+        .merge(data["customers_df"][["customer_id", "customer_state"]], on = "customer_id", how = "left")
+
+    return df.merge(items[["order_id", "product_category_name", "seller_state"]], on = "order_id", how = "left") \
+        .merge(customers[["order_id", "customer_state"]], on = "order_id", how = "left")
+
+
+def get_model_name(target, features) -> str:
+    return f"{target} ~ {' + '.join(features)}"
+
+
+def get_cross_products(design, codes, n_groups) -> np.ndarray:
+    """
+    Returns the sum of the outer product of every row of design with itself, per group
+    (codes), as a (n_groups, columns, columns) array
+    """
+    n_columns = design.shape[1]
+    cross = np.empty((n_groups, n_columns, n_columns))
+
+    for i in range(n_columns):
+        for j in range(i, n_columns):
+            cross[:, i, j] = cross[:, j, i] = np.bincount(codes, weights = design[:, i]*design[:, j],
+                                                          minlength = n_groups)
+
+    return cross
+
+
+def get_aliased_features(xtx, tolerance = ALIAS_TOLERANCE) -> np.ndarray:
+    """
+    Returns whether every feature (the columns of xtx after the constant) is aliased in
+    every group, as a (n_groups, features) array: constant within the group, or a linear
+    combination of the constant and of the features before it that are not aliased
+    """
+    n_groups, n_features = xtx.shape[0], xtx.shape[1] - 1
+
+    # the sums of squares and cross products of the features centred within every group
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        centred = xtx[:, 1:, 1:] - xtx[:, 1:, :1]*xtx[:, :1, 1:]/xtx[:, :1, :1]
+
+    aliased = np.zeros((n_groups, n_features), dtype = bool)
+    for j in range(n_features):
+        kept = ~aliased[:, :j]
+        block = np.where(kept[:, :, None] & kept[:, None, :], centred[:, :j, :j], np.eye(j))
+        cross = np.where(kept, centred[:, :j, j], 0)
+
+        # what is left of the feature once the kept features before it are projected out
+        with np.errstate(invalid = "ignore"):
+            residual = centred[:, j, j] - np.einsum("gi,gij,gj->g", cross, np.linalg.pinv(block, hermitian = True),
+                                                    cross)
+            aliased[:, j] = ~(residual > tolerance*xtx[:, j + 1, j + 1])
+
+    return aliased
+
+
+def solve_models(cross) -> tuple:
+    """
+    Returns the coefficients, their covariance, the number of observations, the residual
+    degrees of freedom, the R² and the aliased features (see get_aliased_features) of the
+    OLS of the last column of cross on the others (the first being the constant), for
+    every group. Aliased features are left out, with a coefficient and covariance of 0.
+    """
+    xtx, xty = cross[:, :-1, :-1], cross[:, :-1, -1]
+    yty, y_sum, n_obs = cross[:, -1, -1], cross[:, 0, -1], cross[:, 0, 0]
+
+    aliased = get_aliased_features(xtx)
+    kept = np.column_stack([np.ones(len(xtx), dtype = bool), ~aliased])
+    pairs = kept[:, :, None] & kept[:, None, :]
+
+    # solving the model of the kept columns only, the others being decoupled from them
+    inverse = np.where(pairs, np.linalg.pinv(np.where(pairs, xtx, np.eye(xtx.shape[1])), hermitian = True), 0)
+    coefs = np.einsum("gij,gj->gi", inverse, xty)
+
+    residual_ss = yty - 2*np.einsum("gi,gi->g", coefs, xty) + np.einsum("gi,gij,gj->g", coefs, xtx, coefs)
+    residual_ss = np.maximum(residual_ss, 0)
+
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        df_resid = n_obs - np.linalg.matrix_rank(np.where(pairs, xtx, 0), hermitian = True)
+        covariance = inverse*np.where(df_resid > 0, residual_ss/df_resid, np.nan)[:, None, None]
+
+        total_ss = yty - y_sum**2/n_obs
+        r_squared = 1 - residual_ss/total_ss
+
+    return coefs, covariance, n_obs, df_resid, r_squared, aliased
+
+
+def fit_grouped_ols(df, target, feature_sets, group_by = None) -> pd.DataFrame:
+    """
+    Fits the OLS (with a constant) of target on every list of features of feature_sets,
+    separately for every group of group_by (a column or list of columns, or None for a
+    single model over all rows). Every model only uses the rows without missing values
+    in its target and features, like statsmodels does.
+
+    Returns a tidy df with a row per model, group and term (const and the features), and
+    its coef, std_err, t_value, p_value and whether it is aliased in that group, and the
+    model's n_obs, df_resid, r_squared and adj_r_squared in that group. Groups without rows
+    for a model are left out. Aliased features have a coef of 0 and NaN std_err, t_value
+    and p_value.
+    """
+    group_by = [] if group_by is None else [group_by] if isinstance(group_by, str) else list(group_by)
+    feature_sets = [list(features) for features in feature_sets]
+    columns = list(dict.fromkeys([target, *(feature for features in feature_sets for feature in features)]))
+
+    # the design matrix of every column any model uses, centered and scaled once for better conditioning
+    values = df[columns].to_numpy(dtype = np.float64, na_value = np.nan)
+    means, scales = np.nanmean(values, axis = 0), np.nanstd(values, axis = 0)
+    scales = np.where((scales > 0) & np.isfinite(scales), scales, 1)
+    scaled = (values - means)/scales
+    position = {column: i for (i, column) in enumerate(columns)}
+
+    if group_by:
+        codes, groups = pd.MultiIndex.from_frame(df[group_by]).factorize()
+        groups = groups.set_names(group_by).to_frame(index = False)
+    else:
+        codes, groups = np.zeros(len(df), dtype = np.int64), pd.DataFrame(index = [0])
+
+    results = []
+    for features in feature_sets:
+        picked = [position[feature] for feature in features]
+        rows = (codes >= 0) & np.isfinite(values[:, [position[target], *picked]]).all(axis = 1)
+
+        design = np.column_stack([np.ones(rows.sum()), scaled[rows][:, picked], values[rows, position[target]]])
+        coefs, covariance, n_obs, df_resid, r_squared, aliased = solve_models(get_cross_products(design, codes[rows],
+                                                                                                 len(groups)))
+
+        # going back from the scaled features to the original ones: slopes are divided by the scales,
+        # and the constant absorbs the means
+        transform = np.diag(np.concatenate([[1], 1/scales[picked]]))
+        transform[0, 1:] = -means[picked]/scales[picked]
+        coefs = coefs @ transform.T
+        std_errs = np.sqrt(np.einsum("ij,gjk,ik->gi", transform, covariance, transform))
+
+        std_errs[:, 1:][aliased] = np.nan
+
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            t_values = coefs/std_errs
+            p_values = 2*stats.t.sf(np.abs(t_values), df_resid[:, None])
+            adj_r_squared = 1 - (n_obs - 1)/df_resid*(1 - r_squared)
+
+        fitted = np.flatnonzero(n_obs > 0)
+        terms = ["const", *features]
+
+        model = groups.iloc[np.repeat(fitted, len(terms))].reset_index(drop = True)
+        model.insert(0, "model", get_model_name(target, features))
+        model["term"] = np.tile(terms, len(fitted))
+        model["coef"] = coefs[fitted].ravel()
+        model["std_err"] = std_errs[fitted].ravel()
+        model["t_value"] = t_values[fitted].ravel()
+        model["p_value"] = p_values[fitted].ravel()
+        model["aliased"] = np.column_stack([np.zeros(len(groups), dtype = bool), aliased])[fitted].ravel()
+
+        for (name, statistic) in [("n_obs", n_obs), ("df_resid", df_resid), ("r_squared", r_squared),
+                                  ("adj_r_squared", adj_r_squared)]:
+            model[name] = np.repeat(statistic[fitted], len(terms))
+
+        results.append(model)
+
+    df = pd.concat(results, ignore_index = True)
+
+    return df.astype({"n_obs": "int64", "df_resid": "int64"})
+
+
+def check_grouped_ols(df, target, feature_sets, group_by = None, rtol = 1e-6):
+    """
+    Fits every model of fit_grouped_ols with statsmodels' OLS, one group at a time, and
+    raises an AssertionError if they differ. Features aliased in a group must leave the
+    rank of its design unchanged, and the other terms must match the statsmodels fit
+    without them.
+    """
+    # importing here, since statsmodels is only needed for checking
+    import statsmodels.api as sm
+
+    group_by = [] if group_by is None else [group_by] if isinstance(group_by, str) else list(group_by)
+    results = fit_grouped_ols(df, target, feature_sets, group_by)
+    groups = df.groupby(group_by, observed = True, sort = False) if group_by else [((), df)]
+
+    for (key, group) in groups:
+        key = key if isinstance(key, tuple) else (key,)
+
+        for features in feature_sets:
+            rows = group[[target, *features]].astype(float).dropna()
+            if len(rows) == 0:
+                continue
+
+            model = results[results["model"] == get_model_name(target, features)]
+            for (column, value) in zip(group_by, key):
+                model = model[model[column] == value]
+            model = model.set_index("term")
+
+            kept = [feature for feature in features if not model.loc[feature, "aliased"]]
+            exog = sm.add_constant(rows[features], has_constant = "add")
+
+            assert np.linalg.matrix_rank(exog.to_numpy()) == np.linalg.matrix_rank(exog[["const", *kept]].to_numpy()), \
+                f"{key} {features}: aliased features that are not"
+            assert (model.loc[model["aliased"], "coef"] == 0).all(), f"{key} {features}: aliased features with a coef"
+
+            fit = sm.OLS(rows[target], exog[["const", *kept]]).fit()
+            expected = pd.DataFrame({"coef": fit.params, "std_err": fit.bse, "p_value": fit.pvalues})
+
+            pd.testing.assert_frame_equal(model.loc[["const", *kept], ["coef", "std_err", "p_value"]], expected,
+                                          rtol = rtol, check_names = False, obj = f"{key} {features}")
+            assert model["n_obs"].iloc[0] == fit.nobs and model["df_resid"].iloc[0] == fit.df_resid, \
+                f"{key} {features}: n_obs or df_resid"
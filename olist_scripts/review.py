@@ -4,17 +4,25 @@ import math
 from olist_scripts.data import Olist
 from olist_scripts.order import Order
 from olist_scripts.product import Product
+from olist_scripts.profiling import instrumented
+from olist_scripts.feature_cache import cached
+from olist_scripts.parallel import requires
+from olist_scripts.keys import decode_frame, encode_frame, get_encoded
+from olist_scripts.facts import get_first_pairs, get_order_item_facts
+from olist_scripts.text import count_characters, get_text_engine, get_text_features
 
 
+@instrumented
+@cached
 class Review:
 
-    def __init__(self):
-        # Import data only once
-        olist = Olist()
-        self.data = olist.retrieve_data()
-        self.order = Order()
-        self.product = Product()
+    def __init__(self, data = None):
+        # Import data only once, and share it with the order and product objects
+        self.data = Olist().retrieve_data() if data is None else data
+        self.order = Order(self.data)
+        self.product = Product(self.data)
 
+    @requires("order_reviews_df")
     def get_review_length(self):
         """
         Returns a DataFrame with:
@@ -22,24 +30,53 @@ class Review:
         """
         revs = self.data["order_reviews_df"]
 
-        revs.loc[revs["review_comment_message"].isna(), "review_comment_message"] = ""
-        revs["length_review"] = revs["review_comment_message"].map(lambda x: len(x))
+        # counting the characters of every message at once, missing messages have 0
+        temp = revs[["review_id"]].copy()
+        temp["length_review"] = count_characters(revs["review_comment_message"])
+        temp["review_score"] = revs["review_score"]
 
-        return revs[["review_id", "length_review", "review_score"]].drop_duplicates()
+        return temp.drop_duplicates()
 
+    @requires("order_reviews_df")
+    def get_text_features(self):
+        """
+        Returns a DataFrame with:
+       'review_id', 'length_title', 'words_title', 'length_message', 'words_message', 'normalized_text'
+        (see olist_scripts.text)
+        """
+        return get_text_features(self.data["order_reviews_df"])
+
+    @requires("order_reviews_df")
+    def get_token_counts(self, ngram_range = (1, 1)):
+        """
+        Returns a sparse matrix with the count of every token (n-gram, for every n in
+        ngram_range) in the title and message of every review, in the order of
+        order_reviews_df, and the token of every column. Tokenized reviews are cached by
+        review_id with the data, so later calls do not tokenize them again.
+        """
+        engine = get_text_engine(self.data, ngram_range)
+
+        return engine.get_token_counts(self.data["order_reviews_df"]), engine.get_vocabulary()
+
+    @requires("orders_df", "order_items_df", "order_reviews_df", "products_df", "product_category_name_translation_df",
+              "sellers_df")
     def get_main_product_category(self):
         """
         Returns a DataFrame with:
        'review_id', 'order_id','product_category_name'
         """
-        prods = self.product.get_training_data()
-        revs = self.data["order_reviews_df"]
-        temp = self.data["order_items_df"].merge(prods, on = "product_id", how = "left").merge(revs, on = "order_id", how = "left")
-        temp = temp.rename(columns = {"category": "product_category_name"})
+        # every distinct order and category of the order item facts (see olist_scripts.facts)
+        facts = get_order_item_facts(self.data)
+        categories = encode_frame(self.data, self.product.get_listing_features()[["product_id", "category"]])
+        items = facts[["order_id", "product_id"]].merge(categories, on = "product_id", how = "left")
 
+        category_codes = pd.factorize(items["category"])[0]
+        temp = items.iloc[get_first_pairs(items["order_id"], category_codes)]
 
-        return temp[["review_id", "order_id", "product_category_name"]].drop_duplicates()
+        revs = get_encoded(self.data, "order_reviews_df", columns = ["order_id", "review_id"])
+        temp = temp.merge(revs, on = "order_id", how = "left").rename(columns = {"category": "product_category_name"})
 
+        return decode_frame(self.data, temp[["review_id", "order_id", "product_category_name"]])
 
     def get_training_data(self):
         """
@@ -0,0 +1,95 @@
+"""
+This script declares the schema of every table of the Olist dataset, so that the
+csv files are loaded with compact dtypes and with their dates already parsed.
+"""
+
+# 32-char hex ids and free text are stored as arrow backed strings
+STRING = "string[pyarrow]"
+
+# columns with few distinct values are stored as categoricals
+CATEGORY = "category"
+
+# the csv files are saved with their index, which has an empty header and is named like this by pandas
+INDEX_COLUMN = "Unnamed: 0"
+
+TABLES = {
+    "customers_df": {
+        "dtypes": {"customer_id": STRING, "customer_unique_id": STRING,
+                   "customer_zip_code_prefix": "int32", "customer_city": CATEGORY,
+                   "customer_state": CATEGORY},
+        "dates": []},
+    "geolocation_df": {
+        "dtypes": {"geolocation_zip_code_prefix": "int32", "geolocation_lat": "float64",
+                   "geolocation_lng": "float64", "geolocation_city": CATEGORY,
+                   "geolocation_state": CATEGORY},
+        "dates": []},
+    "order_items_df": {
+        "dtypes": {"order_id": STRING, "order_item_id": "int32", "product_id": STRING,
+                   "seller_id": STRING, "price": "float64", "freight_value": "float64"},
+        "dates": ["shipping_limit_date"]},
+    "order_payments_df": {
+        "dtypes": {"order_id": STRING, "payment_sequential": "int16", "payment_type": CATEGORY,
+                   "payment_installments": "int16", "payment_value": "float64"},
+        "dates": []},
+    "order_reviews_df": {
+        "dtypes": {"review_id": STRING, "order_id": STRING, "review_score": "int8",
+                   "review_comment_title": STRING, "review_comment_message": STRING},
+        "dates": ["review_creation_date", "review_answer_timestamp"]},
+    "orders_df": {
+        "dtypes": {"order_id": STRING, "customer_id": STRING, "order_status": CATEGORY},
+        "dates": ["order_purchase_timestamp", "order_approved_at", "order_delivered_carrier_date",
+                  "order_delivered_customer_date", "order_estimated_delivery_date"]},
+    "products_df": {
+        "dtypes": {"product_id": STRING, "product_category_name": STRING,
+                   "product_name_lenght": "float32", "product_description_lenght": "float32",
+                   "product_photos_qty": "float32", "product_weight_g": "float32",
+                   "product_length_cm": "float32", "product_height_cm": "float32",
+                   "product_width_cm": "float32"},
+        "dates": []},
+    "product_category_name_translation_df": {
+        "dtypes": {"product_category_name": STRING, "product_category_name_english": STRING},
+        "dates": []},
+    "sellers_df": {
+        "dtypes": {"seller_id": STRING, "seller_zip_code_prefix": "int32",
+                   "seller_city": CATEGORY, "seller_state": CATEGORY},
+        "dates": []},
+    "leads_qualified_df": {
+        "dtypes": {"mql_id": STRING, "landing_page_id": STRING, "origin": CATEGORY},
+        "dates": ["first_contact_date"]},
+    "leads_closed_df": {
+        "dtypes": {"mql_id": STRING, "seller_id": STRING, "sdr_id": STRING, "sr_id": STRING,
+                   "business_segment": CATEGORY, "lead_type": CATEGORY,
+                   "lead_behaviour_profile": CATEGORY, "has_company": "boolean", "has_gtin": "boolean",
+                   "average_stock": CATEGORY, "business_type": CATEGORY,
+                   "declared_product_catalog_size": "float64", "declared_monthly_revenue": "float64"},
+        "dates": ["won_date"]},
+}
+
+
+def get_read_options(key_name, columns = None, engine = "pyarrow") -> dict:
+    """
+    Returns the keyword arguments for pd.read_csv that load the table key_name
+    (e.g. "orders_df") with its declared dtypes and dates. If columns is given,
+    only those columns are read. Tables without a declared schema are read as is.
+
+    The pyarrow engine reads the index column by its empty header, so it is referred
+    to as "" there and has to be renamed to INDEX_COLUMN after reading. The c engine
+    (which can read in chunks) names it INDEX_COLUMN by itself.
+    """
+    index_column = "" if engine == "pyarrow" else INDEX_COLUMN
+    options = {"engine": engine}
+
+    if columns is not None:
+        options["usecols"] = [index_column if column == INDEX_COLUMN else column for column in columns]
+
+    if key_name not in TABLES:
+        return options
+
+    table = TABLES[key_name]
+    options["dtype"] = {index_column: "int32", **table["dtypes"]}
+
+    dates = [date for date in table["dates"] if columns is None or date in columns]
+    if dates:
+        options["parse_dates"] = dates
+
+    return options
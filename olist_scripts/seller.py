@@ -8,18 +8,29 @@ import numpy as np
 import pandas as pd
 from olist_scripts.data import Olist
 from olist_scripts.order import Order
-import datetime
-
+from olist_scripts.timeline import TIMEDELTA_COLUMNS, get_order_timeline
+from olist_scripts.seller_time import get_seller_time_index
+from olist_scripts.streaming import get_streaming_aggregates
+from olist_scripts.sql import get_sqlite
+from olist_scripts.keys import decode_frame, get_encoded
+from olist_scripts.facts import get_order_item_facts, get_order_review_stats
+from olist_scripts.profiling import instrumented
+from olist_scripts.feature_cache import cached
+from olist_scripts.parallel import requires, run_builders
+
+@instrumented
+@cached
 class Seller:
     """
     Dataframes that have seller_id as their index. They have various useful
     features related to seller data.
     """
 
-    def __init__(self):
-        self.data = Olist().retrieve_data()
-        self.order = Order()
+    def __init__(self, data = None):
+        self.data = Olist().retrieve_data() if data is None else data
+        self.order = Order(self.data)
 
+    @requires("sellers_df")
     def get_seller_features(self):
         """
         Returns a df with seller_id, seller_city, seller_state
@@ -29,6 +40,7 @@ class Seller:
 
         return sellers[["seller_id", "seller_city", "seller_state"]]
 
+    @requires("orders_df", "order_items_df", "sellers_df")
     def get_seller_timedeltas(self, is_delivered = True):
         """
         Returns a df with basic timedeltas. Specifically, the average wait_time
@@ -37,49 +49,23 @@ class Seller:
         By default, it calculates these only for delivered orders.
         """
 
-        orders = self.data["orders_df"]
+        # joining and grouping on the integer codes of the ids (see olist_scripts.keys)
+        orders = get_encoded(self.data, "order_timeline", get_order_timeline,
+                             columns = ["order_id", "order_status", *TIMEDELTA_COLUMNS])
 
         if is_delivered:
-            orders = orders[orders["order_status"] == "delivered"].copy()
-
-
-        items = self.data["order_items_df"]
-        sellers = self.data["sellers_df"]
-
-        # converting dates to datetime objects
-        temp_list = ["order_purchase_timestamp", "order_approved_at", "order_delivered_carrier_date",
-             "order_delivered_customer_date", "order_estimated_delivery_date"]
-
-        for obj in temp_list:
-            orders[obj] = pd.to_datetime(orders[obj])
-
-        # creating one day datetime object to convert timedeltas into decimal numbers by dividing by it
-        one_day_delta = datetime.timedelta(days=1)
-
-        # calculating new series
-        orders.loc[:,"wait_time"] = (orders["order_delivered_customer_date"] - \
-            orders["order_purchase_timestamp"])/one_day_delta
+            orders = orders[orders["order_status"] == "delivered"]
 
-        orders.loc[:,"expected_wait_time"] = (orders["order_estimated_delivery_date"] - \
-                                            orders["order_purchase_timestamp"])/one_day_delta
+        items = get_encoded(self.data, "order_items_df", columns = ["order_id", "seller_id"])
 
-        orders.loc[:,"delay_vs_expected"] = (orders["order_delivered_customer_date"] - \
-                                            orders["order_estimated_delivery_date"])/one_day_delta
-
-        orders.loc[:,"seller_to_carrier"] = (orders["order_delivered_carrier_date"] - \
-                                            orders["order_purchase_timestamp"])/one_day_delta
-
-        orders.loc[:,"carrier_to_customer"] = (orders["order_delivered_customer_date"] - \
-                                            orders["order_delivered_carrier_date"])/one_day_delta
-
-        temp = orders.merge(items, on = "order_id", how = "left").merge(sellers, \
-            on = "seller_id", how = "left")
+        temp = orders.merge(items, on = "order_id", how = "left")
 
         df = temp.groupby(by = "seller_id", as_index = False)[["wait_time", "expected_wait_time", \
             "delay_vs_expected", "seller_to_carrier", "carrier_to_customer"]].mean()
 
-        return df
+        return decode_frame(self.data, df)
 
+    @requires("orders_df", "order_items_df", "sellers_df")
     def get_active_dates(self):
         """
         Returns a df that has as features the first sale's and last sale's data per seller
@@ -92,94 +78,110 @@ class Seller:
         This will of course be causing some data leakage, but it shouldn't be too significant.
         """
 
-        orders = self.data["orders_df"]
-        items = self.data["order_items_df"]
-        sellers = self.data["sellers_df"]
-
-        tmp = orders.merge(items, on = "order_id", how = "left").merge(sellers, on = "seller_id", how = "left")
-
-        # engineering first and last orders, as well as total time on olist
-        first_order = tmp.sort_values("order_purchase_timestamp").drop_duplicates(subset = "seller_id") \
-            .loc[:, ["seller_id", "order_purchase_timestamp"]] \
-                .rename(columns = {"order_purchase_timestamp": "first_order"}).dropna()
-
-        last_order = tmp.sort_values("order_purchase_timestamp", ascending = False) \
-            .drop_duplicates(subset = "seller_id").loc[:, ["seller_id", "order_purchase_timestamp"]] \
-                .rename(columns = {"order_purchase_timestamp": "last_order"}).dropna()
+        # reading the first and last orders off the seller time index (see olist_scripts.seller_time)
+        tmp = get_seller_time_index(self.data).get_window()
 
-        tmp = first_order.merge(last_order, how = "left", on = "seller_id")
+        return tmp.sort_values(["first_order", "seller_id"], kind = "stable", ignore_index = True) \
+            .loc[:, ["seller_id", "first_order", "last_order", "months_on_olist"]]
 
-        # creating one day datetime object to convert timedeltas into decimal numbers by dividing by it
-        one_day_delta = datetime.timedelta(days=1)
-
-        # converting dates to datetime objects
-        temp_list = ["first_order", "last_order"]
-
-        for obj in temp_list:
-            tmp[obj] = pd.to_datetime(tmp[obj])
+    @requires("orders_df", "order_items_df", "sellers_df")
+    def get_window_metrics(self, start = None, end = None, as_of = None):
+        """
+        Returns a df with the first and last order, the months on Olist, the order count and
+        the revenue of every seller with orders in [start, end). as_of is the same as end,
+        and only one of them can be given. Either bound can be left out.
+        """
+        if as_of is not None and end is not None:
+            raise ValueError("end and as_of are both the end of the window, only one of them can be given")
 
-        tmp["months_on_olist"] = round((tmp.loc[:,"last_order"] - tmp.loc[:,"first_order"])/(one_day_delta*30)+1)
+        return get_seller_time_index(self.data).get_window(start, end if as_of is None else as_of)
 
-        return tmp
+    @requires("orders_df", "order_items_df", "sellers_df")
+    def get_monthly_kpis(self, window = 3):
+        """
+        Returns a df with a row per seller and month since its first order, with the orders
+        and revenue of the month, of the last window months and since the first order, and
+        the months on Olist at the end of the month
+        """
+        return get_seller_time_index(self.data).get_monthly_kpis(window)
 
-    def get_quantitative_features(self):
+    @requires("orders_df", "order_items_df", "products_df", "sellers_df")
+    def get_quantitative_features(self, chunk_size = None, backend = "pandas"):
         """
         Returns a df that contains the total amount of orders that the seller participated in, the
         total amount of items sold by a seller and the items sold per order of the seller. Also
         returns the total revenue and the revenue per order for the seller.
-        """
 
-        orders = self.data["orders_df"]
-        items = self.data["order_items_df"]
-        sellers = self.data["sellers_df"]
+        If chunk_size is given, it is computed out of core from the csv files, reading at most
+        chunk_size rows at a time (see olist_scripts.streaming). With backend = "sqlite", it
+        is aggregated by sqlite from the sqlite file instead (see olist_scripts.sql).
+        """
+        if backend == "sqlite":
+            return get_sqlite(self.data).get_quantitative_features()
+        if chunk_size is not None:
+            return get_streaming_aggregates(self.data, chunk_size).get_quantitative_features()
 
-        tmp = orders.merge(items, on = "order_id", how = "left").merge(sellers, on = "seller_id", how = "left")
+        # reducing the items of known orders of the order item facts (see olist_scripts.facts)
+        facts = get_order_item_facts(self.data)
+        facts = facts[facts["known_order"] & (facts["seller_id"] >= 0)]
 
-        tmp = tmp.groupby(by = "seller_id", as_index = False) \
+        tmp = facts.groupby(by = "seller_id", as_index = False) \
             .agg({"order_id": "nunique", "order_item_id": "sum", "price": "sum"})
 
         tmp.columns = ["seller_id", "order_count", "total_items_sold", "revenue"]
 
+        # orders without items made total_items_sold a float in the joins this replaced
+        tmp["total_items_sold"] = tmp["total_items_sold"].astype("float64")
+
         tmp["items_per_order"] = tmp["total_items_sold"]/tmp["order_count"]
         tmp["revenue_per_order"] = tmp["revenue"]/tmp["order_count"]
 
-        return tmp
+        return decode_frame(self.data, tmp)
 
-    def get_review_score(self):
+    @requires("orders_df", "order_items_df", "products_df", "sellers_df", "order_reviews_df")
+    def get_review_score(self, chunk_size = None):
         """
         Returns a dataframe that has the average review per seller, and the share of 1-star and 5-star
         reviews they had.
-        """
 
-        orders = self.data["orders_df"]
-        items = self.data["order_items_df"]
-        sellers = self.data["sellers_df"]
-        reviews = self.data["order_reviews_df"]
-        temp = sellers.drop(["Unnamed: 0"], axis = 1)
-
-        tmp = orders.merge(reviews, on = "order_id", how = "left").merge(items, on = "order_id", how = "left") \
-           .merge(temp, on = "seller_id", how = "left").drop_duplicates()
+        If chunk_size is given, it is computed out of core from the csv files, reading at most
+        chunk_size rows at a time (see olist_scripts.streaming).
+        """
+        if chunk_size is not None:
+            return get_streaming_aggregates(self.data, chunk_size).get_review_score()
 
-        tmp["one_star"] = (tmp["review_score"] == 1).astype(int)
-        tmp["five_star"] = (tmp["review_score"] == 5).astype(int)
+        # every item of a known order counts once per review of its order, or once if it has none,
+        # like in a join of the items with the reviews (see olist_scripts.facts)
+        facts = get_order_item_facts(self.data)
+        facts = facts[facts["known_order"] & (facts["order_id"] >= 0) & (facts["seller_id"] >= 0)]
+        reviews = get_order_review_stats(self.data).iloc[facts["order_id"].to_numpy()]
 
-        df = tmp.groupby(by = "seller_id", as_index = False).agg({"one_star": "sum", "five_star": "sum", \
-            "review_score": "mean", "order_id": "count"})
+        tmp = pd.DataFrame({"seller_id": facts["seller_id"].to_numpy(),
+                            "one_star": reviews["one_star"].to_numpy(),
+                            "five_star": reviews["five_star"].to_numpy(),
+                            "score_sum": reviews["score_sum"].to_numpy(),
+                            "score_count": reviews["score_count"].to_numpy(),
+                            "order_count": np.maximum(reviews["n_reviews"].to_numpy(), 1)})
 
-        df.rename(columns = {"order_id": "order_count"}, inplace = True)
+        df = tmp.groupby(by = "seller_id", as_index = False).sum()
+        df.insert(3, "review_score", df.pop("score_sum")/df.pop("score_count"))
 
         df["share_of_one_stars"] = df["one_star"]/df["order_count"]
         df["share_of_five_stars"] = df["five_star"]/df["order_count"]
 
-        return df
+        return decode_frame(self.data, df)
 
-    def get_training_data(self):
+    def get_training_data(self, executor = "serial"):
         """
         Returns a df that has all the features related to sellers, done by the
-        methods above.
+        methods above. They are built by executor, "serial", "thread" or "process"
+        (see olist_scripts.parallel), with the same results.
         """
-
-        return self.get_active_dates().merge(self.get_quantitative_features(), on = "seller_id", how = "left") \
-            .merge(self.get_review_score(), on = "seller_id", how = "left") \
-            .merge(self.get_seller_features(), on  = "seller_id", how = "left") \
-            .merge(self.get_seller_timedeltas(), on = "seller_id", how = "left")
+        active_dates, quantitative, review_score, seller_features, timedeltas = run_builders(self, [
+            "get_active_dates", "get_quantitative_features", "get_review_score", "get_seller_features",
+            "get_seller_timedeltas"], executor)
+
+        return active_dates.merge(quantitative, on = "seller_id", how = "left") \
+            .merge(review_score, on = "seller_id", how = "left") \
+            .merge(seller_features, on  = "seller_id", how = "left") \
+            .merge(timedeltas, on = "seller_id", how = "left")
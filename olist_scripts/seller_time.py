@@ -0,0 +1,162 @@
+"""
+This script indexes the orders of every seller by purchase time for my Olist project,
+so that seller metrics (first and last order, months on Olist, order count and
+revenue) can be computed for any time window, or as of any date, by binary search
+instead of joining and sorting everything again. It also computes monthly rolling
+KPIs for every seller at once.
+"""
+
+import numpy as np
+import pandas as pd
+from olist_scripts.data import get_derived
+from olist_scripts.keys import decode, encode, get_dictionary, get_encoded
+
+THIRTY_DAYS = np.timedelta64(30, "D")
+
+
+def to_datetime64(date) -> np.datetime64:
+    return np.datetime64(pd.Timestamp(date), "ns")
+
+
+def get_months_on_olist(first_order, last_order) -> np.ndarray:
+    """
+    Returns the months between the first and last order, counting the first month
+    (see Seller.get_active_dates)
+    """
+    return np.round((last_order - first_order)/THIRTY_DAYS + 1)
+
+
+class SellerTimeIndex:
+    """
+    The orders of every seller (one entry per seller and order, with its purchase time
+    and the revenue of the seller's items in it), sorted by seller and then by time.
+
+    Every seller's entries are a contiguous run, and within it the times are sorted, so
+    the entries of any window are found by binary search. To search the runs of all the
+    sellers at once, every entry gets the key seller code * (number of times + 1) + rank
+    of its time, which is sorted over the whole index.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+        orders = get_encoded(data, "orders_df", columns = ["order_id", "order_purchase_timestamp"])
+        items = get_encoded(data, "order_items_df", columns = ["order_id", "seller_id", "price"])
+
+        # only the items of known orders count, like in the joins starting from orders_df
+        df = items.merge(orders, on = "order_id")
+        df = df[(df["seller_id"] >= 0) & df["order_purchase_timestamp"].notna()]
+
+        entries = df.groupby(["seller_id", "order_id"], sort = False) \
+            .agg(time = ("order_purchase_timestamp", "first"), revenue = ("price", "sum")).reset_index()
+
+        order = np.lexsort((entries["time"].to_numpy(), entries["seller_id"].to_numpy()))
+        self.sellers = entries["seller_id"].to_numpy()[order].astype(np.int64)
+        self.times = entries["time"].to_numpy()[order].astype("datetime64[ns]")
+        self.cumulative_revenue = np.concatenate([[0.0], np.cumsum(entries["revenue"].to_numpy()[order])])
+
+        self.n_sellers = len(get_dictionary(data, "seller_id"))
+        self.distinct_times = np.unique(self.times)
+        self.keys = self.sellers*(len(self.distinct_times) + 1) + np.searchsorted(self.distinct_times, self.times)
+
+    def get_bounds(self, seller_codes, start = None, end = None) -> tuple:
+        """
+        Returns where the entries of every seller in [start, end) start and end
+        """
+        first_rank = 0 if start is None else np.searchsorted(self.distinct_times, to_datetime64(start))
+        last_rank = len(self.distinct_times) if end is None else \
+            np.searchsorted(self.distinct_times, to_datetime64(end))
+
+        base = seller_codes.astype(np.int64)*(len(self.distinct_times) + 1)
+
+        return np.searchsorted(self.keys, base + first_rank), np.searchsorted(self.keys, base + last_rank)
+
+    def get_window(self, start = None, end = None, seller_ids = None) -> pd.DataFrame:
+        """
+        Returns a df with the first_order, last_order, months_on_olist, order_count and
+        revenue of every seller (or only of seller_ids) within [start, end), where either
+        bound can be left open. Sellers without orders in the window are left out.
+        """
+        if seller_ids is None:
+            seller_codes = np.arange(self.n_sellers)
+        else:
+            seller_codes = encode(self.data, "seller_id", pd.Series(seller_ids))
+            seller_codes = seller_codes[seller_codes >= 0]
+
+        lower, upper = self.get_bounds(seller_codes, start, end)
+        active = upper > lower
+        seller_codes, lower, upper = seller_codes[active], lower[active], upper[active]
+
+        df = pd.DataFrame({"seller_id": decode(self.data, "seller_id", seller_codes),
+                           "first_order": self.times[lower],
+                           "last_order": self.times[upper - 1]})
+
+        df["months_on_olist"] = get_months_on_olist(df["first_order"], df["last_order"])
+        df["order_count"] = (upper - lower).astype(np.int64)
+        df["revenue"] = self.cumulative_revenue[upper] - self.cumulative_revenue[lower]
+
+        return df
+
+    def as_of(self, date, seller_ids = None) -> pd.DataFrame:
+        """
+        Returns the metrics of get_window over every order placed before date
+        """
+        return self.get_window(end = date, seller_ids = seller_ids)
+
+    def get_monthly_kpis(self, window = 3) -> pd.DataFrame:
+        """
+        Returns a df with a row per seller and month from the seller's first order on,
+        with the orders and revenue of the month, of the last window months (including
+        it) and since the first order, and the months_on_olist as of the end of the month.
+        """
+        if not isinstance(window, (int, np.integer)) or window < 1:
+            raise ValueError(f"window should be a whole number of months, at least 1, not {window!r}")
+
+        months = self.times.astype("datetime64[M]")
+        first_month = months.min() if len(months) else np.datetime64("2016-01", "M")
+        month_index = (months - first_month).astype(np.int64)
+        n_months = int(month_index.max()) + 1 if len(months) else 0
+
+        # the orders, revenue and last order of every seller (rows) and month (columns)
+        cells = self.sellers*n_months + month_index
+        shape = (self.n_sellers, n_months)
+        orders = np.bincount(cells, minlength = shape[0]*shape[1]).reshape(shape)
+        revenue = np.bincount(cells, weights = np.diff(self.cumulative_revenue),
+                              minlength = shape[0]*shape[1]).reshape(shape)
+
+        last_order = np.full(shape[0]*shape[1], np.iinfo(np.int64).min)
+        np.maximum.at(last_order, cells, self.times.view(np.int64))
+        last_order = np.maximum.accumulate(last_order.reshape(shape), axis = 1)
+
+        cumulative_orders, cumulative_revenue = orders.cumsum(axis = 1), revenue.cumsum(axis = 1)
+        rolling_orders, rolling_revenue = cumulative_orders.copy(), cumulative_revenue.copy()
+        rolling_orders[:, window:] -= cumulative_orders[:, :-window]
+        rolling_revenue[:, window:] -= cumulative_revenue[:, :-window]
+
+        # every seller's first order is the first entry of its run
+        first_order = np.zeros(self.n_sellers, dtype = np.int64)
+        starts = np.flatnonzero(np.diff(self.sellers, prepend = -1))
+        first_order[self.sellers[starts]] = self.times.view(np.int64)[starts]
+
+        seller_codes, month_codes = np.nonzero(cumulative_orders > 0)
+
+        df = pd.DataFrame({"seller_id": decode(self.data, "seller_id", seller_codes),
+                           "month": (first_month + month_codes.astype("timedelta64[M]")).astype("datetime64[ns]"),
+                           "orders": orders[seller_codes, month_codes].astype(np.int64),
+                           "revenue": revenue[seller_codes, month_codes],
+                           "rolling_orders": rolling_orders[seller_codes, month_codes].astype(np.int64),
+                           "rolling_revenue": rolling_revenue[seller_codes, month_codes],
+                           "cumulative_orders": cumulative_orders[seller_codes, month_codes].astype(np.int64),
+                           "cumulative_revenue": cumulative_revenue[seller_codes, month_codes]})
+
+        df["months_on_olist"] = get_months_on_olist(first_order[seller_codes].view("datetime64[ns]"),
+                                                    last_order[seller_codes, month_codes].view("datetime64[ns]"))
+
+        return df
+
+
+def get_seller_time_index(data) -> SellerTimeIndex:
+    """
+    Returns the seller time index of data, built once and then shared
+    """
+    return get_derived(data, "seller_time_index", SellerTimeIndex)
@@ -0,0 +1,115 @@
+"""
+This script keeps binary snapshots (Arrow IPC files) of the Olist tables for my Olist
+project. The first load of a table parses its csv file and writes a snapshot, the later
+ones memory-map the snapshot instead, which is much faster than parsing the csv again.
+
+Running it as a script pre-warms the snapshots, e.g.
+    python -m olist_scripts.snapshot --data-dir data/
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+import pandas as pd
+import pyarrow as pa
+from olist_scripts.schema import TABLES
+
+# bumped whenever the way snapshots are written changes, to rebuild the old ones
+SNAPSHOT_VERSION = 1
+
+SNAPSHOT_DIR_NAME = ".snapshots"
+
+# arrow strings are read back as arrow backed pandas strings, like the csv loader does
+STRING_TYPES = {pa.string(): pd.StringDtype("pyarrow"), pa.large_string(): pd.StringDtype("pyarrow")}
+
+
+def get_csv_fingerprint(csv_file, key_name) -> str:
+    """
+    Returns a short hash of the csv file's size and modification time, together with the
+    declared schema of its table. If any of them changes, so does the fingerprint.
+    """
+    stat = os.stat(csv_file)
+    source = json.dumps([SNAPSHOT_VERSION, stat.st_size, stat.st_mtime_ns, TABLES.get(key_name)],
+                        sort_keys = True)
+
+    return hashlib.sha1(source.encode()).hexdigest()[:16]
+
+
+def get_snapshot_path(snapshot_dir, key_name, fingerprint) -> str:
+    """
+    Returns the path of the snapshot of key_name with the given fingerprint
+    """
+    return os.path.join(snapshot_dir, f"{key_name}-{fingerprint}.arrow")
+
+
+def read_snapshot(path, columns = None) -> pd.DataFrame:
+    """
+    Memory-maps a snapshot and returns it as a df, only with the given columns if any
+    """
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+
+    if columns is not None:
+        table = table.select(list(columns))
+
+    return table.to_pandas(types_mapper = STRING_TYPES.get)
+
+
+def write_snapshot(df, path):
+    """
+    Writes df as an uncompressed Arrow IPC file, so that it can be memory-mapped.
+    The file is written under a temporary name first, so that readers never see half
+    a snapshot, and older snapshots of the same table are removed.
+    """
+    table = pa.Table.from_pandas(df, preserve_index = False)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+
+    with pa.OSFile(temp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    os.replace(temp_path, path)
+
+    # removing stale snapshots of this table
+    key_name = os.path.basename(path).rsplit("-", 1)[0]
+    for old_path in glob.glob(os.path.join(os.path.dirname(path), f"{key_name}-*.arrow")):
+        if old_path != path:
+            os.remove(old_path)
+
+
+def clear_snapshots(snapshot_dir):
+    """
+    Deletes every table snapshot ({key_name}-{fingerprint}.arrow) in snapshot_dir, leaving
+    the other files kept there (e.g. the cubes of olist_scripts.cubes) alone
+    """
+    for path in glob.glob(os.path.join(snapshot_dir, "*_df-*.arrow")):
+        os.remove(path)
+
+
+def main(argv = None):
+    # importing here, since data.py itself uses this script
+    from olist_scripts.data import Olist
+
+    parser = argparse.ArgumentParser(description = "Pre-warms the binary snapshots of the Olist csv files")
+    parser.add_argument("--data-dir", default = None, help = "directory with the csv files (default: data/)")
+    parser.add_argument("--clear", action = "store_true", help = "delete the existing snapshots first")
+    args = parser.parse_args(argv)
+
+    olist = Olist(args.data_dir)
+
+    if args.clear:
+        clear_snapshots(olist.snapshot_dir)
+
+    for file in olist.get_file_names():
+        key_name = file.replace(".csv", "_df")
+
+        start = time.perf_counter()
+        df = olist.read_table(key_name)
+        print(f"{key_name}: {len(df)} rows in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+This script reads the Olist dataset straight from its sqlite file (data/olist.sqlite,
+the one the sqlite notebook exports to csv) for my Olist project, and runs some of the
+per seller and per product aggregations as SQL, so that only their result reaches
+pandas. The tables and aggregates are the same as the ones of the csv path.
+"""
+
+import os
+import sqlite3
+import pandas as pd
+from olist_scripts.schema import INDEX_COLUMN, TABLES
+
+SQLITE_FILE_NAME = "olist.sqlite"
+
+# the columns the joins and lookups go through, indexed when the file is opened
+INDEXED_COLUMNS = {"orders": ["order_id", "customer_id"],
+                   "order_items": ["order_id", "seller_id", "product_id"],
+                   "order_reviews": ["order_id"],
+                   "order_payments": ["order_id"],
+                   "products": ["product_id"],
+                   "sellers": ["seller_id", "seller_zip_code_prefix"],
+                   "customers": ["customer_id", "customer_zip_code_prefix"],
+                   "geolocation": ["geolocation_zip_code_prefix"]}
+
+QUANTITATIVE_FEATURES_QUERY = """
+    SELECT i.seller_id AS seller_id,
+           COUNT(DISTINCT o.order_id) AS order_count,
+           SUM(i.order_item_id) AS total_items_sold,
+           SUM(i.price) AS revenue
+    FROM orders o
+    JOIN order_items i ON i.order_id = o.order_id
+    LEFT JOIN sellers s ON s.seller_id = i.seller_id
+    WHERE i.seller_id IS NOT NULL
+    GROUP BY i.seller_id
+    ORDER BY i.seller_id
+"""
+
+SALES_FEATURES_QUERY = """
+    SELECT p.product_id AS product_id,
+           COUNT(DISTINCT i.order_id) AS n_orders,
+           COUNT(i.order_item_id) AS n_items_sold,
+           AVG(i.price) AS mean_price
+    FROM products p
+    LEFT JOIN order_items i ON i.product_id = p.product_id
+    WHERE p.product_id IS NOT NULL
+    GROUP BY p.product_id
+    ORDER BY p.product_id
+"""
+
+
+def quote(name) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+class OlistSQLite:
+    """
+    The Olist sqlite file at path. Opening it creates the indexes of INDEXED_COLUMNS,
+    unless the file is read-only.
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"no sqlite file at {path}")
+
+        self.path = path
+        self.create_indexes()
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path)
+
+    def get_table_names(self) -> list:
+        """
+        Returns the sorted names of the tables in the file, e.g. "orders"
+        """
+        with self.connect() as connection:
+            rows = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+
+        return sorted(name for (name,) in rows)
+
+    def get_columns(self, table) -> list:
+        with self.connect() as connection:
+            return [row[1] for row in connection.execute(f"PRAGMA table_info({quote(table)})")]
+
+    def create_indexes(self):
+        """
+        Creates the indexes of INDEXED_COLUMNS that are missing, for the tables and
+        columns the file has
+        """
+        tables = self.get_table_names()
+
+        try:
+            with self.connect() as connection:
+                for (table, columns) in INDEXED_COLUMNS.items():
+                    if table not in tables:
+                        continue
+
+                    existing = self.get_columns(table)
+                    for column in columns:
+                        if column in existing:
+                            connection.execute(f"CREATE INDEX IF NOT EXISTS {quote(f'idx_{table}_{column}')} "
+                                               f"ON {quote(table)} ({quote(column)})")
+        except sqlite3.OperationalError:
+            # a read-only file only means that the queries are slower
+            pass
+
+    def query(self, sql, params = ()) -> pd.DataFrame:
+        with self.connect() as connection:
+            return pd.read_sql_query(sql, connection, params = params)
+
+    def read_table(self, key_name, columns = None) -> pd.DataFrame:
+        """
+        Reads a single table (e.g. "orders_df") with the dtypes and dates declared in
+        olist_scripts.schema, like Olist.parse_csv does. The csv files hold the row
+        number as their first column, so it is added here as INDEX_COLUMN.
+        """
+        table = key_name.replace("_df", "")
+        columns = [INDEX_COLUMN, *self.get_columns(table)] if columns is None else list(columns)
+
+        selected = [f"ROW_NUMBER() OVER (ORDER BY rowid) - 1 AS {quote(INDEX_COLUMN)}" if column == INDEX_COLUMN
+                    else quote(column) for column in columns]
+        df = self.query(f"SELECT {', '.join(selected)} FROM {quote(table)} ORDER BY rowid")
+
+        return apply_schema(df, key_name)
+
+    def get_quantitative_features(self) -> pd.DataFrame:
+        """
+        Same as Seller.get_quantitative_features, aggregated by sqlite
+        """
+        df = self.query(QUANTITATIVE_FEATURES_QUERY)
+
+        df = df.astype({"seller_id": TABLES["sellers_df"]["dtypes"]["seller_id"], "order_count": "int64",
+                        "total_items_sold": "float64", "revenue": "float64"})
+
+        df["items_per_order"] = df["total_items_sold"]/df["order_count"]
+        df["revenue_per_order"] = df["revenue"]/df["order_count"]
+
+        return df
+
+    def get_sales_features(self) -> pd.DataFrame:
+        """
+        Same as Product.get_sales_features, aggregated by sqlite
+        """
+        df = self.query(SALES_FEATURES_QUERY)
+
+        df = df.astype({"product_id": TABLES["products_df"]["dtypes"]["product_id"], "n_orders": "int64",
+                        "n_items_sold": "int64", "mean_price": "float64"})
+
+        df["total_revenue"] = df["n_orders"]*df["mean_price"]
+
+        return df
+
+
+def apply_schema(df, key_name) -> pd.DataFrame:
+    """
+    Casts the columns of df to the dtypes and dates declared for the table key_name
+    """
+    if key_name not in TABLES:
+        return df
+
+    table = TABLES[key_name]
+    dtypes = {INDEX_COLUMN: "int32", **table["dtypes"]}
+    df = df.astype({column: dtype for (column, dtype) in dtypes.items() if column in df})
+
+    for column in table["dates"]:
+        if column in df:
+            df[column] = pd.to_datetime(df[column]).astype("datetime64[ns]")
+
+    return df
+
+
+def get_sqlite(data) -> OlistSQLite:
+    """
+    Returns the sqlite file next to the csv files data was loaded from (or in data/
+    for plain dictionaries of dataframes)
+    """
+    # importing here, since olist_scripts.data imports this module
+    from olist_scripts.data import Olist
+
+    olist = getattr(data, "olist", None) or Olist()
+
+    return OlistSQLite(olist.sqlite_file)
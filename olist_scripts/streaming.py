@@ -0,0 +1,144 @@
+"""
+This script computes the per seller and per product aggregates of my Olist project out
+of core, for datasets too large to join in memory. It gives the same results as
+Seller.get_quantitative_features, Seller.get_review_score, Seller.get_active_dates and
+Product.get_sales_features.
+
+The orders, order items and reviews are read in chunks of chunk_size rows and spilled
+to disk, partitioned by a hash of their order_id. Every partition then holds all the
+rows of its orders, so its partial aggregates (see olist_scripts.incremental) can be
+computed on their own and added up. Peak memory is about a chunk plus a partition,
+whatever the size of the data.
+"""
+
+import math
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from olist_scripts.data import Olist, get_derived
+from olist_scripts.incremental import ORDER_COLUMNS, ITEM_COLUMNS, REVIEW_COLUMNS, PartialAggregates, \
+    get_contributions
+from olist_scripts.schema import get_read_options
+from olist_scripts.snapshot import STRING_TYPES
+
+STREAMED_COLUMNS = {"orders_df": ORDER_COLUMNS, "order_items_df": ITEM_COLUMNS,
+                    "order_reviews_df": REVIEW_COLUMNS}
+
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+
+def get_partitions(order_ids, n_partitions) -> np.ndarray:
+    """
+    Returns the partition of every order id, the same for the same id in any table
+    """
+    hashes = pd.util.hash_pandas_object(order_ids, index = False).to_numpy()
+
+    return (hashes % n_partitions).astype(np.int64)
+
+
+def estimate_rows(csv_file, sample_lines = 1_000) -> int:
+    """
+    Returns an estimate of the number of rows of csv_file, from the length of its first lines
+    """
+    with open(csv_file, "rb") as file:
+        lengths = [len(line) for (_, line) in zip(range(sample_lines + 1), file)][1:]
+
+    if not lengths:
+        return 0
+
+    return int(os.path.getsize(csv_file)/np.mean(lengths))
+
+
+def read_chunks(olist, key_name, chunk_size):
+    """
+    Yields the streamed columns of the table key_name, chunk_size rows at a time
+    """
+    csv_file = os.path.join(olist.csv_path, key_name.replace("_df", ".csv"))
+    options = get_read_options(key_name, STREAMED_COLUMNS[key_name], engine = "c")
+
+    with pd.read_csv(csv_file, chunksize = chunk_size, **options) as reader:
+        for chunk in reader:
+            yield chunk[STREAMED_COLUMNS[key_name]]
+
+
+def spill_partitions(olist, key_name, spill_dir, n_partitions, chunk_size):
+    """
+    Reads the table key_name in chunks and appends every chunk's rows to the Arrow
+    stream file of their partition, in spill_dir.
+    """
+    paths = [os.path.join(spill_dir, f"{key_name}-{partition}.arrow") for partition in range(n_partitions)]
+    writers = []
+
+    try:
+        for chunk in read_chunks(olist, key_name, chunk_size):
+            table = pa.Table.from_pandas(chunk, preserve_index = False)
+
+            # opening every partition file with the schema of the first chunk
+            if not writers:
+                schema = table.schema
+                writers = [pa.ipc.new_stream(path, schema) for path in paths]
+
+            partitions = get_partitions(chunk["order_id"], n_partitions)
+            for partition in np.unique(partitions):
+                writers[partition].write_table(table.filter(pa.array(partitions == partition)).cast(schema))
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def read_partition(path, columns) -> pd.DataFrame:
+    """
+    Reads back a spilled partition, or an empty df if nothing was spilled
+    """
+    if not os.path.exists(path):
+        return pd.DataFrame(columns = columns)
+
+    with pa.OSFile(path, "rb") as source:
+        return pa.ipc.open_stream(source).read_all().to_pandas(types_mapper = STRING_TYPES.get)
+
+
+class StreamingAggregates(PartialAggregates):
+    """
+    Per seller and per product aggregates computed out of core from the csv files of
+    olist (by default the ones in data/), reading at most chunk_size rows at a time.
+    The partitions are spilled to a temporary directory inside spill_dir (by default
+    the system's temporary directory) and deleted afterwards. Only an olist reading the
+    csv files (the csv backend) can be streamed.
+    """
+
+    def __init__(self, olist = None, chunk_size = DEFAULT_CHUNK_SIZE, n_partitions = None, spill_dir = None):
+        olist = olist or Olist()
+        if olist.backend != "csv":
+            raise ValueError(f"only the csv files can be streamed, not the {olist.backend} backend")
+
+        # about one chunk worth of order items per partition
+        if n_partitions is None:
+            items_csv = os.path.join(olist.csv_path, "order_items.csv")
+            n_partitions = max(1, math.ceil(estimate_rows(items_csv)/chunk_size))
+
+        with tempfile.TemporaryDirectory(dir = spill_dir) as temp_dir:
+            for key_name in STREAMED_COLUMNS:
+                spill_partitions(olist, key_name, temp_dir, n_partitions, chunk_size)
+
+            for partition in range(n_partitions):
+                orders, items, reviews = (read_partition(os.path.join(temp_dir, f"{key_name}-{partition}.arrow"),
+                                                         columns) for (key_name, columns) in STREAMED_COLUMNS.items())
+                contributions = get_contributions(orders, items, reviews)
+
+                if partition == 0:
+                    super().__init__(*contributions, olist.read_table("products_df", ["product_id"])["product_id"])
+                else:
+                    self.combine(*contributions)
+
+
+def get_streaming_aggregates(data, chunk_size = DEFAULT_CHUNK_SIZE) -> StreamingAggregates:
+    """
+    Returns the aggregates streamed from the csv files data was loaded from (or in data/
+    for plain dictionaries of dataframes), reading at most chunk_size rows at a time.
+    They are streamed once per dataset and chunk_size, and then shared.
+    """
+    olist = getattr(data, "olist", None) or Olist()
+
+    return get_derived(data, f"streaming_aggregates_{chunk_size}", lambda data: StreamingAggregates(olist, chunk_size))
@@ -0,0 +1,273 @@
+"""
+This is a script that generates a synthetic, referentially consistent version
+of the Olist dataset for my Olist project. It writes the same csv files the
+sqlite notebook exports, so every script can run (and be benchmarked) offline.
+"""
+
+import argparse
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+from olist_scripts.sql import SQLITE_FILE_NAME
+
+# row counts of the Kaggle dataset, i.e. scale factor 1
+BASE_SIZES = {"orders": 99_441, "customers": 99_441, "sellers": 3_095,
+              "products": 32_951, "zip_prefixes": 19_015, "geolocation": 1_000_163}
+
+STATES = ["SP", "RJ", "MG", "RS", "PR", "SC", "BA", "DF", "ES", "GO", "PE", "CE", "PA", "MT",
+          "MA", "MS", "PB", "PI", "RN", "AL", "SE", "TO", "RO", "AM", "AC", "AP", "RR"]
+
+CATEGORIES = {"cama_mesa_banho": "bed_bath_table", "beleza_saude": "health_beauty",
+              "esporte_lazer": "sports_leisure", "moveis_decoracao": "furniture_decor",
+              "informatica_acessorios": "computers_accessories", "utilidades_domesticas": "housewares",
+              "relogios_presentes": "watches_gifts", "telefonia": "telephony",
+              "ferramentas_jardim": "garden_tools", "automotivo": "auto", "brinquedos": "toys",
+              "cool_stuff": "cool_stuff", "perfumaria": "perfumery", "bebes": "baby",
+              "eletronicos": "electronics", "papelaria": "stationery", "fashion_bolsas_e_acessorios":
+              "fashion_bags_accessories", "pet_shop": "pet_shop", "moveis_escritorio": "office_furniture",
+              "consoles_games": "consoles_games"}
+
+ORDER_STATUSES = ["delivered", "shipped", "canceled", "unavailable", "invoiced", "processing",
+                  "created", "approved"]
+STATUS_WEIGHTS = [0.97, 0.011, 0.006, 0.006, 0.003, 0.002, 0.001, 0.001]
+
+PAYMENT_TYPES = ["credit_card", "boleto", "voucher", "debit_card"]
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _hex_ids(rng, n):
+    """
+    Returns n unique 32-char hex ids, like the ones Olist uses for its entities
+    """
+    raw = rng.integers(0, 2**63, size = (n, 2), dtype = np.int64).view(np.uint64)
+    ids = np.char.add(np.char.zfill(np.char.mod("%x", raw[:, 0]), 16), np.char.zfill(np.char.mod("%x", raw[:, 1]), 16))
+
+    return ids.astype(object)
+
+
+def _format(timestamps):
+    """
+    Formats a datetime series the way the csv export does, keeping missing values empty
+    """
+    return timestamps.dt.strftime(TIMESTAMP_FORMAT)
+
+
+def generate(scale = 0.01, seed = 42):
+    """
+    Returns a dictionary like the one Olist().retrieve_data() returns, containing a synthetic
+    dataset whose size is the Kaggle one multiplied by scale. The same scale and seed always
+    give the same data.
+    """
+    rng = np.random.default_rng(seed)
+    sizes = {name: max(int(round(size*scale)), 20) for (name, size) in BASE_SIZES.items()}
+
+    # zip prefixes, each one with a state, a city and a centroid around which geolocation rows scatter
+    zips = np.sort(rng.choice(np.arange(1_000, 99_999), size = sizes["zip_prefixes"], replace = False))
+    zip_state = np.array(STATES)[np.minimum(zips*len(STATES)//100_000, len(STATES) - 1)]
+    zip_city = np.char.add("city_", (zips//100).astype(str))
+    zip_lat = -33.0 + 28.0*zips/100_000 + rng.normal(0, 0.5, zips.size)
+    zip_lng = -35.0 - 20.0*rng.random(zips.size)
+
+    # a few prefixes used by customers and sellers are missing from geolocation, like in the real data
+    geo_zips = rng.permutation(zips)[:int(zips.size*0.99)]
+    geo_pick = rng.choice(np.searchsorted(zips, geo_zips), size = sizes["geolocation"])
+    geolocation = pd.DataFrame({"geolocation_zip_code_prefix": zips[geo_pick],
+                                "geolocation_lat": zip_lat[geo_pick] + rng.normal(0, 0.01, geo_pick.size),
+                                "geolocation_lng": zip_lng[geo_pick] + rng.normal(0, 0.01, geo_pick.size),
+                                "geolocation_city": zip_city[geo_pick],
+                                "geolocation_state": zip_state[geo_pick]})
+
+    customer_zip = rng.integers(0, zips.size, sizes["customers"])
+    customers = pd.DataFrame({"customer_id": _hex_ids(rng, sizes["customers"]),
+                              "customer_unique_id": _hex_ids(rng, sizes["customers"]),
+                              "customer_zip_code_prefix": zips[customer_zip],
+                              "customer_city": zip_city[customer_zip],
+                              "customer_state": zip_state[customer_zip]})
+
+    seller_zip = rng.integers(0, zips.size, sizes["sellers"])
+    sellers = pd.DataFrame({"seller_id": _hex_ids(rng, sizes["sellers"]),
+                            "seller_zip_code_prefix": zips[seller_zip],
+                            "seller_city": zip_city[seller_zip],
+                            "seller_state": zip_state[seller_zip]})
+
+    # products, with a couple percent of them missing their category like in the real data
+    category_names = np.array(list(CATEGORIES.keys()), dtype = object)
+    product_category = category_names[rng.integers(0, category_names.size, sizes["products"])]
+    product_category[rng.random(sizes["products"]) < 0.02] = None
+    products = pd.DataFrame({"product_id": _hex_ids(rng, sizes["products"]),
+                             "product_category_name": product_category,
+                             "product_name_lenght": rng.integers(5, 76, sizes["products"]).astype(float),
+                             "product_description_lenght": rng.integers(4, 3_993, sizes["products"]).astype(float),
+                             "product_photos_qty": rng.integers(1, 11, sizes["products"]).astype(float),
+                             "product_weight_g": rng.integers(50, 30_000, sizes["products"]).astype(float),
+                             "product_length_cm": rng.integers(7, 105, sizes["products"]).astype(float),
+                             "product_height_cm": rng.integers(2, 105, sizes["products"]).astype(float),
+                             "product_width_cm": rng.integers(6, 118, sizes["products"]).astype(float)})
+
+    translation = pd.DataFrame({"product_category_name": list(CATEGORIES.keys()),
+                                "product_category_name_english": list(CATEGORIES.values())})
+
+    # orders, spread over two years, with their delivery timeline
+    n_orders = sizes["orders"]
+    start = pd.Timestamp("2016-09-01").value
+    span = pd.Timestamp("2018-09-01").value - start
+    purchase = pd.Series(pd.to_datetime(start + rng.integers(0, span, n_orders)).floor("s"))
+    approved = purchase + pd.to_timedelta(rng.exponential(0.4, n_orders), unit = "D").round("s")
+    carrier = approved + pd.to_timedelta(rng.exponential(2.5, n_orders), unit = "D").round("s")
+    delivered = carrier + pd.to_timedelta(rng.gamma(2.0, 4.5, n_orders), unit = "D").round("s")
+    estimated = (purchase + pd.to_timedelta(rng.integers(10, 40, n_orders), unit = "D")).dt.normalize()
+
+    status = rng.choice(ORDER_STATUSES, size = n_orders, p = STATUS_WEIGHTS)
+    not_shipped = ~np.isin(status, ["delivered", "shipped"])
+    carrier[not_shipped] = pd.NaT
+    delivered[status != "delivered"] = pd.NaT
+    approved[status == "created"] = pd.NaT
+
+    orders = pd.DataFrame({"order_id": _hex_ids(rng, n_orders),
+                           "customer_id": customers["customer_id"].to_numpy()[rng.permutation(n_orders) \
+                                % sizes["customers"]],
+                           "order_status": status,
+                           "order_purchase_timestamp": _format(purchase),
+                           "order_approved_at": _format(approved),
+                           "order_delivered_carrier_date": _format(carrier),
+                           "order_delivered_customer_date": _format(delivered),
+                           "order_estimated_delivery_date": _format(estimated)})
+
+    # items, most orders with one item and some with several, from one or more sellers
+    n_items = np.minimum(rng.geometric(0.85, n_orders), 21)
+    n_items[status == "unavailable"] = 0
+    item_order = np.repeat(np.arange(n_orders), n_items)
+    item_number = np.arange(item_order.size) - np.repeat(np.cumsum(n_items) - n_items, n_items) + 1
+
+    # sellers and products are popularity skewed, items of the same order mostly share a seller
+    seller_pick = np.minimum(rng.zipf(1.3, n_orders) - 1, sizes["sellers"] - 1)[item_order]
+    other_seller = rng.random(item_order.size) < 0.05
+    seller_pick[other_seller] = rng.integers(0, sizes["sellers"], other_seller.sum())
+    product_pick = np.minimum(rng.zipf(1.2, item_order.size) - 1, sizes["products"] - 1)
+    price = np.round(rng.lognormal(4.4, 0.9, sizes["products"]), 2)[product_pick]
+
+    order_items = pd.DataFrame({"order_id": orders["order_id"].to_numpy()[item_order],
+                                "order_item_id": item_number,
+                                "product_id": products["product_id"].to_numpy()[product_pick],
+                                "seller_id": sellers["seller_id"].to_numpy()[seller_pick],
+                                "shipping_limit_date": _format(purchase.iloc[item_order].reset_index(drop = True) \
+                                    + pd.Timedelta(days = 6)),
+                                "price": price,
+                                "freight_value": np.round(rng.gamma(2.0, 10.0, item_order.size), 2)})
+
+    # reviews, roughly one per order with a few orders reviewed twice and a few reviews shared
+    review_order = np.concatenate([np.arange(n_orders), rng.integers(0, n_orders, n_orders//100)])
+    review_ids = _hex_ids(rng, review_order.size)
+    shared = rng.random(review_order.size) < 0.005
+    review_ids[shared] = review_ids[rng.integers(0, review_order.size, shared.sum())]
+    late = (delivered > estimated).to_numpy()[review_order]
+    score = np.where(late, rng.choice([1, 2, 3, 4, 5], review_order.size, p = [0.45, 0.1, 0.15, 0.15, 0.15]),
+                     rng.choice([1, 2, 3, 4, 5], review_order.size, p = [0.08, 0.03, 0.08, 0.2, 0.61]))
+    words = np.array(["produto", "entrega", "otimo", "recomendo", "chegou", "antes", "prazo", "bom",
+                      "nao", "veio", "errado", "qualidade", "excelente", "atrasou", "gostei"], dtype = object)
+    n_words = rng.integers(0, 25, review_order.size)
+    message = np.array([" ".join(words[rng.integers(0, words.size, n)]) if n else None for n in n_words],
+                       dtype = object)
+    title = np.where(rng.random(review_order.size) < 0.12, words[rng.integers(0, words.size, review_order.size)],
+                     None)
+    created = (purchase.iloc[review_order].reset_index(drop = True) \
+        + pd.to_timedelta(rng.integers(5, 40, review_order.size), unit = "D")).dt.normalize()
+    answered = created + pd.to_timedelta(rng.exponential(2.0, review_order.size), unit = "D").round("s")
+
+    order_reviews = pd.DataFrame({"review_id": review_ids,
+                                  "order_id": orders["order_id"].to_numpy()[review_order],
+                                  "review_score": score,
+                                  "review_comment_title": title,
+                                  "review_comment_message": message,
+                                  "review_creation_date": _format(created),
+                                  "review_answer_timestamp": _format(answered)})
+
+    # payments, one per order with a few split ones
+    payment_order = np.concatenate([np.arange(n_orders), rng.integers(0, n_orders, n_orders//20)])
+    payment_order.sort()
+    order_value = np.bincount(item_order, weights = order_items["price"] + order_items["freight_value"],
+                              minlength = n_orders)
+    sequential = np.arange(payment_order.size) - np.searchsorted(payment_order, payment_order) + 1
+    split = np.bincount(payment_order, minlength = n_orders)[payment_order]
+    order_payments = pd.DataFrame({"order_id": orders["order_id"].to_numpy()[payment_order],
+                                   "payment_sequential": sequential,
+                                   "payment_type": rng.choice(PAYMENT_TYPES, payment_order.size,
+                                                              p = [0.74, 0.19, 0.055, 0.015]),
+                                   "payment_installments": rng.integers(1, 11, payment_order.size),
+                                   "payment_value": np.round(order_value[payment_order]/split, 2)})
+
+    return {"customers_df": customers,
+            "geolocation_df": geolocation,
+            "order_items_df": order_items,
+            "order_payments_df": order_payments,
+            "order_reviews_df": order_reviews,
+            "orders_df": orders,
+            "products_df": products,
+            "product_category_name_translation_df": translation,
+            "sellers_df": sellers}
+
+
+def write_dataset(destination, scale = 0.01, seed = 42, overwrite = False):
+    """
+    Writes the synthetic dataset as csv files to destination, the same way the
+    sqlite notebook does (including the saved index). Returns the written paths.
+
+    A destination that already has csv files (e.g. data/, with the real ones) is
+    refused, unless overwrite is True.
+    """
+    existing = sorted(name for name in os.listdir(destination) if name[-4:] == ".csv") \
+        if os.path.isdir(destination) else []
+    if existing and not overwrite:
+        raise FileExistsError(f"{destination} already has csv files ({', '.join(existing)}), "
+                              "pass overwrite = True (--overwrite) to replace them")
+
+    os.makedirs(destination, exist_ok = True)
+
+    paths = []
+    for (key_name, df) in generate(scale, seed).items():
+        csv_file_name = os.path.join(destination, key_name.replace("_df", ".csv"))
+        df.to_csv(csv_file_name)
+        paths.append(csv_file_name)
+
+    return paths
+
+
+def write_sqlite(path, scale = 0.01, seed = 42, overwrite = False):
+    """
+    Writes the synthetic dataset as the sqlite file the csv files are exported from
+    (one table per csv file, without the saved index) to path. An existing file is
+    never replaced, unless overwrite is True.
+    """
+    if os.path.exists(path):
+        if not overwrite:
+            raise FileExistsError(f"{path} already exists, pass overwrite = True (--overwrite) to replace it")
+
+        os.remove(path)
+
+    with sqlite3.connect(path) as connection:
+        for (key_name, df) in generate(scale, seed).items():
+            df.to_sql(key_name.replace("_df", ""), connection, index = False)
+
+    return path
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Writes a synthetic Olist dataset as csv files")
+    parser.add_argument("destination", help = "directory to write the csv files to")
+    parser.add_argument("--scale", type = float, default = 0.01, help = "size relative to the Kaggle dataset")
+    parser.add_argument("--seed", type = int, default = 42)
+    parser.add_argument("--sqlite", action = "store_true", help = f"also write the tables to {SQLITE_FILE_NAME}")
+    parser.add_argument("--overwrite", action = "store_true", help = "replace the files already in destination")
+    args = parser.parse_args(argv)
+
+    for path in write_dataset(args.destination, args.scale, args.seed, args.overwrite):
+        print(path)
+
+    if args.sqlite:
+        print(write_sqlite(os.path.join(args.destination, SQLITE_FILE_NAME), args.scale, args.seed, args.overwrite))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+This script engineers features out of the review texts for my Olist project, for the
+sentiment analysis: character and word counts, normalized text and token/n-gram
+counts as sparse matrices. Everything runs as vectorized string operations over the
+Arrow backed review columns, instead of a Python call per review.
+
+The tokens of every review are cached by review_id, once per dataset, so calling it
+again on the same dataset does not tokenize the reviews again. The cache is dropped
+together with the rest of the data when a csv file changes.
+"""
+
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from scipy import sparse
+from olist_scripts.data import get_derived
+
+TEXT_COLUMNS = ["review_comment_title", "review_comment_message"]
+
+
+def to_arrow(texts) -> pa.Array:
+    """
+    Returns texts (a series or anything pyarrow accepts) as a single Arrow string array
+    """
+    if isinstance(texts, pd.Series):
+        texts = texts.array
+
+    array = pa.array(texts, type = pa.string(), from_pandas = True)
+
+    return array.combine_chunks() if isinstance(array, pa.ChunkedArray) else array
+
+
+def normalize_text(texts) -> pa.Array:
+    """
+    Returns the texts in lower case, without accents, punctuation or repeated
+    whitespace, e.g. "Ótimo, recomendo!!" becomes "otimo recomendo". Nulls stay null.
+    """
+    texts = pc.utf8_normalize(to_arrow(texts), "NFKD")
+
+    # dropping the accents, which NFKD split off their letters as combining marks
+    texts = pc.utf8_lower(pc.replace_substring_regex(texts, r"\p{Mn}+", ""))
+    texts = pc.replace_substring_regex(texts, r"[^a-z0-9]+", " ")
+
+    return pc.utf8_trim_whitespace(texts)
+
+
+def count_characters(texts) -> np.ndarray:
+    """
+    Returns the number of characters of every text, 0 for nulls
+    """
+    return pc.fill_null(pc.utf8_length(to_arrow(texts)), 0).to_numpy().astype(np.int64)
+
+
+def count_words(texts) -> np.ndarray:
+    """
+    Returns the number of whitespace separated words of every text, 0 for nulls
+    """
+    words = pc.utf8_split_whitespace(pc.utf8_trim_whitespace(to_arrow(texts)))
+    parents = pc.list_parent_indices(words)
+
+    # splitting an empty text gives one empty word, which is not counted
+    non_empty = pc.greater(pc.utf8_length(pc.list_flatten(words)), 0)
+
+    return np.bincount(parents.filter(non_empty).to_numpy(), minlength = len(words)).astype(np.int64)
+
+
+def join_texts(reviews) -> pa.Array:
+    """
+    Returns the title and message of every review, joined by a space. Reviews without
+    either are just the other one, and reviews without both are null.
+    """
+    title, message = (to_arrow(reviews[column]) for column in TEXT_COLUMNS)
+
+    joined = pc.binary_join_element_wise(title, message, " ", null_handling = "replace", null_replacement = "")
+    has_text = pc.or_(pc.is_valid(title), pc.is_valid(message))
+
+    return pc.if_else(has_text, pc.utf8_trim_whitespace(joined), pa.scalar(None, pa.string()))
+
+
+def get_text_features(reviews) -> pd.DataFrame:
+    """
+    Returns a df with the review_id, the number of characters and words of the title
+    and the message, and the normalized text (title and message) of every review
+    """
+    df = pd.DataFrame({"review_id": reviews["review_id"].array})
+
+    for (column, name) in [("review_comment_title", "title"), ("review_comment_message", "message")]:
+        df[f"length_{name}"] = count_characters(reviews[column])
+        df[f"words_{name}"] = count_words(reviews[column])
+
+    df["normalized_text"] = pd.array(normalize_text(join_texts(reviews)), dtype = "string[pyarrow]")
+
+    return df
+
+
+def get_ngrams(texts, ngram_range = (1, 1)) -> tuple:
+    """
+    Returns the n-grams (for every n in ngram_range) of the normalized texts, and the
+    position of the text each one comes from
+    """
+    words = pc.utf8_split_whitespace(normalize_text(texts))
+    tokens = pc.list_flatten(words)
+    parents = pc.list_parent_indices(words).to_numpy()
+
+    # splitting an empty text gives one empty token
+    non_empty = pc.greater(pc.utf8_length(tokens), 0)
+    tokens, parents = tokens.filter(non_empty), parents[non_empty.to_numpy(zero_copy_only = False)]
+
+    grams, gram_parents = [], []
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        length = len(tokens) - n + 1
+        if length <= 0:
+            continue
+
+        # an n-gram starting at token i is made of tokens i to i + n - 1, if they belong to the same text
+        same_text = parents[:length] == parents[n - 1:n - 1 + length]
+        joined = pc.binary_join_element_wise(*[tokens.slice(k, length) for k in range(n)], " ")
+
+        grams.append(joined.filter(pa.array(same_text)))
+        gram_parents.append(parents[:length][same_text])
+
+    if not grams:
+        return pa.array([], pa.string()), np.array([], dtype = np.int64)
+
+    return pa.concat_arrays(grams), np.concatenate(gram_parents)
+
+
+class ReviewTextEngine:
+    """
+    Tokenizes review texts (title and message) into n-grams (for every n in ngram_range)
+    and counts them per review. The token ids of every review are cached by review_id,
+    assuming that a review's text never changes (and that reviews sharing a review_id,
+    one review for several orders, share their text). The vocabulary only grows, so
+    that the columns of earlier matrices keep their meaning.
+    """
+
+    def __init__(self, ngram_range = (1, 1)):
+        self.ngram_range = tuple(ngram_range)
+        self.vocabulary = pd.Index([], dtype = "string[pyarrow]")
+
+        # the token ids of all cached reviews, one after another, and where each review starts
+        self.review_ids = pd.Index([], dtype = "string[pyarrow]")
+        self.token_ids = np.array([], dtype = np.int64)
+        self.offsets = np.array([0], dtype = np.int64)
+
+        self._lock = threading.Lock()
+
+    def tokenize(self, reviews):
+        """
+        Tokenizes the reviews whose review_id is not cached yet, and caches their token ids
+        """
+        with self._lock:
+            # looking the review ids up in the index, which is much faster than isin on Arrow strings
+            new = reviews[self.review_ids.get_indexer(reviews["review_id"]) < 0].drop_duplicates(subset = "review_id")
+            if len(new) == 0:
+                return
+
+            grams, parents = get_ngrams(join_texts(new), self.ngram_range)
+
+            # giving the grams that were never seen before the next ids, in order of appearance
+            codes, uniques = pd.factorize(pd.Series(pd.array(grams, dtype = "string[pyarrow]")))
+            ids = self.vocabulary.get_indexer(uniques)
+            unseen = ids < 0
+            ids[unseen] = len(self.vocabulary) + np.arange(unseen.sum())
+            self.vocabulary = self.vocabulary.append(pd.Index(uniques[unseen], dtype = "string[pyarrow]"))
+
+            # grouping the token ids by review, in the order of the new reviews
+            order = np.argsort(parents, kind = "stable")
+            lengths = np.bincount(parents, minlength = len(new))
+
+            self.review_ids = self.review_ids.append(pd.Index(new["review_id"].array))
+            self.token_ids = np.concatenate([self.token_ids, ids[codes][order]])
+            self.offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum(lengths)])
+
+    def get_token_counts(self, reviews) -> sparse.csr_matrix:
+        """
+        Returns a sparse matrix with a row per review (in the order of reviews) and a
+        column per token of the vocabulary, counting how many times the review uses it
+        """
+        self.tokenize(reviews)
+
+        # taking the cache together, since other threads may be appending reviews to it
+        with self._lock:
+            review_ids, token_ids, offsets, vocabulary = self.review_ids, self.token_ids, self.offsets, self.vocabulary
+
+        positions = review_ids.get_indexer(reviews["review_id"])
+        starts, lengths = offsets[positions], np.diff(offsets)[positions]
+
+        # gathering the token ids of every review, which lie from its start to its start plus its length
+        gathered = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        rows = np.repeat(np.arange(len(reviews)), lengths)
+
+        counts = sparse.csr_matrix((np.ones(len(rows), dtype = np.int64), (rows, token_ids[gathered])),
+                                   shape = (len(reviews), len(vocabulary)))
+        counts.sum_duplicates()
+
+        return counts
+
+    def get_vocabulary(self) -> list:
+        """
+        Returns the token of every column of the count matrices
+        """
+        return list(self.vocabulary)
+
+
+def get_text_engine(data, ngram_range = (1, 1)) -> ReviewTextEngine:
+    """
+    Returns the engine of data for ngram_range, built once and then shared so that its
+    cache is too. Plain dictionaries of dataframes get a new engine every time.
+    """
+    ngram_range = tuple(ngram_range)
+
+    return get_derived(data, f"text_engine_{ngram_range}", lambda data: ReviewTextEngine(ngram_range))
@@ -0,0 +1,55 @@
+"""
+This script builds the order timeline for my Olist project: a per order table with
+the time (in days) that each step of the delivery took. It is built once per dataset
+and shared by Order, Seller and Product, instead of each of them computing it.
+"""
+
+import numpy as np
+import pandas as pd
+from olist_scripts.data import get_derived
+
+TIMEDELTA_COLUMNS = ["wait_time", "expected_wait_time", "delay_vs_expected",
+                     "seller_to_carrier", "carrier_to_customer"]
+
+ONE_DAY = np.timedelta64(1, "D")
+
+
+def _days_between(end, start) -> np.ndarray:
+    """
+    Returns end - start in decimal days as float32, NaN where either date is missing
+    """
+    return ((end - start)/ONE_DAY).astype(np.float32)
+
+
+def build_order_timeline(data) -> pd.DataFrame:
+    """
+    Returns a df with order_id, customer_id, order_status, order_purchase_timestamp and the
+    timedeltas of every order, namely total wait time (wait_time), predicted wait time
+    (expected_wait_time), how much time the prediction was off (delay_vs_expected, negative
+    if it got there early), time from purchase to the carrier (seller_to_carrier) and from
+    the carrier to the customer (carrier_to_customer).
+    """
+    orders = data["orders_df"]
+
+    purchase = orders["order_purchase_timestamp"].to_numpy()
+    carrier = orders["order_delivered_carrier_date"].to_numpy()
+    delivered = orders["order_delivered_customer_date"].to_numpy()
+    estimated = orders["order_estimated_delivery_date"].to_numpy()
+
+    timeline = orders[["order_id", "customer_id", "order_status", "order_purchase_timestamp"]].copy()
+
+    timeline["wait_time"] = _days_between(delivered, purchase)
+    timeline["expected_wait_time"] = _days_between(estimated, purchase)
+    timeline["delay_vs_expected"] = _days_between(delivered, estimated)
+    timeline["seller_to_carrier"] = _days_between(carrier, purchase)
+    timeline["carrier_to_customer"] = _days_between(delivered, carrier)
+
+    return timeline
+
+
+def get_order_timeline(data) -> pd.DataFrame:
+    """
+    Returns the order timeline of data (see build_order_timeline), built once and then
+    shared. It should be copied before being modified.
+    """
+    return get_derived(data, "order_timeline", build_order_timeline)